@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+
+"""
+benchmarks on deterministic synthetic data, nothing to download
+times every phase of heatmap.py, raw_iq.py and flatten.py on its own,
+results go to JSON so two versions can be compared with --compare
+"""
+
+import os, sys, json, time, shutil, platform, tempfile, argparse
+import numpy
+import heatmap
+from heatmap import HeatmapGenerator
+import power_csv
+import raw_iq
+import flatten
+from instrument import peak_rss, reset_peak_rss
+
+start_epoch = 1704067200  # 2024-01-01 00:00:00 UTC
+sweep_seconds = 10
+hop_hz = 2000000
+base_hz = 88000000
+
+
+def csv_sweeps(hops, bins, sweeps, noise=0.01, seed=1):
+    """yields rtl_power lines, a noise floor, a few carriers and some -inf and -1.#J values"""
+    rng = numpy.random.RandomState(seed)
+    step = hop_hz / float(bins)
+    x = numpy.arange(hops * bins)
+    carriers = numpy.zeros(hops * bins)
+    for center in rng.randint(0, hops * bins, max(1, hops * 2)):
+        carriers += 30 * numpy.exp(-((x - center) / 3.0) ** 2)
+    for s in range(sweeps):
+        levels = -45 + carriers + rng.normal(0, 4, hops * bins)
+        tokens = numpy.char.mod('%.2f', levels.round(2)).astype(object)
+        bad = rng.random_sample(hops * bins) < noise
+        tokens[bad] = numpy.where(rng.random_sample(bad.sum()) < 0.5, '-inf', '-1.#J')
+        # rtl_power stamps every hop of a sweep with the same time
+        t = power_csv.epoch_to_time(start_epoch + s * sweep_seconds)
+        for h in range(hops):
+            low = base_hz + h * hop_hz
+            yield '%s, %i, %i, %.2f, 10, %s\n' % (t.replace(' ', ', '), low, low + hop_hz, step,
+                                                   ', '.join(tokens[h * bins:(h + 1) * bins]))
+
+
+def write_csv(path, hops, bins, sweeps, gz=False, noise=0.01):
+    """gz writes the indexed multi-member gzip, so --jobs can split it"""
+    lines = csv_sweeps(hops, bins, sweeps, noise)
+    if gz:
+        power_csv.write_gzip(lines, path)
+        return
+    with open(path, 'w') as fd:
+        fd.writelines(lines)
+
+
+def write_iq(path, sample, samples, seed=1):
+    """two tones in noise, quantized the way raw_iq.to_complex reads them back"""
+    rng = numpy.random.RandomState(seed)
+    dtype, offset, scale = raw_iq.sample_types[sample]
+    n = numpy.arange(samples)
+    signal = 0.3 * numpy.exp(2j * numpy.pi * 0.05 * n) + 0.1 * numpy.exp(-2j * numpy.pi * 0.21 * n)
+    signal = signal + rng.normal(0, 0.05, samples) + 1j * rng.normal(0, 0.05, samples)
+    raw = numpy.empty(2 * samples)
+    raw[0::2] = signal.real
+    raw[1::2] = signal.imag
+    if dtype == numpy.float32:
+        raw.astype(numpy.float32).tofile(path)
+        return
+    info = numpy.iinfo(dtype)
+    numpy.clip(numpy.round(raw * scale - offset), info.min, info.max).astype(dtype).tofile(path)
+
+
+class Bench(object):
+    """collects one record per timed phase"""
+
+    def __init__(self, repeat=1):
+        self.repeat = repeat
+        self.results = []
+
+    def phase(self, case, name, call, rows=0, size=0):
+        """runs call repeat times and keeps the fastest, returns its last result
+        cpu time is this process only, pool workers are not counted"""
+        best = None
+        for i in range(self.repeat):
+            reset_peak_rss()
+            cpu0, wall0 = time.process_time(), time.perf_counter()
+            result = call()
+            wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+            if best is None or wall < best['wall']:
+                best = {'case': case, 'phase': name, 'wall': wall, 'cpu': cpu,
+                        'rows': rows, 'bytes': size, 'peak_rss_mb': round(peak_rss(), 1)}
+        best['rows_per_s'] = rows / best['wall'] if best['wall'] else 0
+        best['mb_per_s'] = size / 1e6 / best['wall'] if best['wall'] else 0
+        self.results.append(best)
+        print("%-22s %-16s %8.3fs wall %8.3fs cpu %12.0f rows/s %8.1f MB/s %8.1f MB peak" % (
+            case, name, best['wall'], best['cpu'], best['rows_per_s'], best['mb_per_s'], best['peak_rss_mb']))
+        return result
+
+
+def quietly(call, *a):
+    """the scripts print their progress, keep the table readable"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return call(*a)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def bench_csv(bench, path, case, jobs):
+    size = os.path.getsize(path)
+    rows = sum(1 for line in power_csv.read_lines(path))
+    generator = HeatmapGenerator()
+    generator.jobs = jobs
+
+    def summary():
+        # --repeat measures the parse, not the cache of --batch
+        heatmap.summary_cache.clear()
+        generator.min_z, generator.max_z = 100, -100
+        quietly(generator.calc_summary, path)
+        quietly(generator.calc_legends_height)
+        generator.init_heatmap()
+
+    bench.phase(case, 'calc_summary', summary, rows, size)
+    bench.phase(case, 'draw_heatmap', lambda: quietly(generator.draw_heatmap, path), rows, size)
+    bench.phase(case, 'label_heatmap', lambda: quietly(generator.label_heatmap), len(generator.times))
+    out = os.path.join(os.path.dirname(path), case + '.png')
+    bench.phase(case, 'save', lambda: quietly(generator.save, out), len(generator.times))
+    names = ['mean', 'max', 'p90']
+    bench.phase(case, 'flatten.py', lambda: flatten.pooled_stats([path], names, None, jobs), rows, size)
+
+
+def bench_iq(bench, path, case, sample, bins, averages, jobs):
+    size = os.path.getsize(path)
+    source = raw_iq.IQFile(path, sample)
+    frames = raw_iq.frame_count(source.length, bins, raw_iq.frame_hop(bins, 0))
+    rows = -(-frames // averages)
+    table = bench.phase(case, 'raw_iq.psd',
+                        lambda: raw_iq.psd_parallel(source, bins, averages, jobs=jobs), rows, size)
+    bench.phase(case, 'raw_iq.heatmap', lambda: raw_iq.heatmap(table), len(table))
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': numpy.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def compare(old, new):
+    """wall time ratios of the phases both runs have, above 1 is a speedup"""
+    before = dict(((r['case'], r['phase']), r) for r in old['results'])
+    for r in new['results']:
+        o = before.get((r['case'], r['phase']))
+        if o is None or not r['wall']:
+            continue
+        print("%-22s %-16s %8.3fs -> %8.3fs  x%.2f" % (r['case'], r['phase'], o['wall'], r['wall'], o['wall'] / r['wall']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scripts on synthetic rtl_power CSV and raw IQ.')
+    parser.add_argument('--hops', dest='hops', type=int, default=8,
+                        help='Hops per sweep. (default 8)')
+    parser.add_argument('--bins', dest='bins', type=int, default=256,
+                        help='Bins per hop. (default 256)')
+    parser.add_argument('--sweeps', dest='sweeps', type=int, default=1000,
+                        help='Number of sweeps. (default 1000)')
+    parser.add_argument('--noise', dest='noise', type=float, default=0.01,
+                        help='Fraction of -inf and -1.#J values. (default 0.01)')
+    parser.add_argument('--gzip', dest='gzip', default='both', choices=['off', 'on', 'both'],
+                        help='Plain CSV, indexed gzip or both. (default both)')
+    parser.add_argument('--iq-samples', dest='iq_samples', type=int, default=2**23,
+                        help='Complex samples per IQ file. (default 8M)')
+    parser.add_argument('--iq-types', dest='iq_types', default='u1,s1,s2',
+                        help='Comma separated sample types. (default u1,s1,s2)')
+    parser.add_argument('--iq-bins', dest='iq_bins', type=int, default=1024,
+                        help='FFT size for raw_iq. (default 1024)')
+    parser.add_argument('--averages', dest='averages', type=int, default=10,
+                        help='Frames per raw_iq row. (default 10)')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help='Passed to the pooled code paths. (default 1)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+                        help='Run each phase N times and keep the fastest.')
+    parser.add_argument('--workdir', dest='workdir', default=None,
+                        help='Where the synthetic files go, kept afterwards. (default a temporary folder)')
+    parser.add_argument('--json', dest='json_path', default=None,
+                        help='Write the results to this JSON file.')
+    parser.add_argument('--compare', dest='compare_path', default=None,
+                        help='Previous JSON results to compare against.')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='rtl_bench_')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    config = dict(vars(args))
+    bench = Bench(args.repeat)
+    try:
+        for gz in {'off': [False], 'on': [True], 'both': [False, True]}[args.gzip]:
+            # the name holds everything the data depends on, a kept --workdir never mixes sizes
+            name = 'sweeps_%ih_%ib_%is_%gn.csv' % (args.hops, args.bins, args.sweeps, args.noise)
+            path = os.path.join(workdir, name + ('.gz' if gz else ''))
+            if not os.path.exists(path):
+                print("generating", path)
+                write_csv(path, args.hops, args.bins, args.sweeps, gz, args.noise)
+            bench_csv(bench, path, 'csv_gz' if gz else 'csv', args.jobs)
+        for sample in args.iq_types.split(','):
+            path = os.path.join(workdir, 'iq_%s_%i.raw' % (sample, args.iq_samples))
+            if not os.path.exists(path):
+                print("generating", path)
+                write_iq(path, sample, args.iq_samples)
+            bench_iq(bench, path, 'iq_' + sample, sample, args.iq_bins, args.averages, args.jobs)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    report = {'environment': environment(), 'config': config, 'results': bench.results}
+    if args.json_path:
+        with open(args.json_path, 'w') as fd:
+            json.dump(report, fd, indent=4)
+    if args.compare_path:
+        with open(args.compare_path) as fd:
+            compare(json.load(fd), report)
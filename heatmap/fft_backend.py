@@ -0,0 +1,108 @@
+"""
+pluggable fft for the psd code, rows of frames in, rows of spectra out
+scipy.fft with worker threads, pyfftw with cached plans and wisdom, numpy as the fallback
+"""
+
+import os, sys
+import numpy
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+wisdom_path = os.path.expanduser('~/.rtl_fftw_wisdom')
+
+
+class NumpyFFT(object):
+    """single threaded, the baseline"""
+    name = 'numpy'
+
+    def __init__(self, threads=1):
+        self.threads = 1
+
+    def fft(self, frames):
+        return numpy.fft.fft(frames, axis=1)
+
+
+class ScipyFFT(object):
+    """pocketfft keeps its own plan cache, workers splits the rows over threads"""
+    name = 'scipy'
+
+    def __init__(self, threads=1):
+        self.threads = threads
+
+    def fft(self, frames):
+        return scipy_fft.fft(frames, axis=1, workers=self.threads)
+
+
+class FFTWBackend(object):
+    """one plan per block shape, wisdom saved between runs
+    the returned array is the plan's output buffer, use it before the next call"""
+    name = 'pyfftw'
+
+    def __init__(self, threads=1, wisdom=wisdom_path):
+        self.threads = threads
+        self.wisdom = wisdom
+        self.plans = {}
+        # forked pool workers would all rewrite the file at once
+        self.owner = os.getpid()
+        self.load_wisdom()
+
+    def load_wisdom(self):
+        if not self.wisdom or not os.path.exists(self.wisdom):
+            return
+        with open(self.wisdom, 'rb') as fd:
+            pyfftw.import_wisdom(tuple(fd.read().split(b'\0\0')))
+
+    def save_wisdom(self):
+        if not self.wisdom or os.getpid() != self.owner:
+            return
+        try:
+            with open(self.wisdom, 'wb') as fd:
+                fd.write(b'\0\0'.join(pyfftw.export_wisdom()))
+        except IOError:
+            pass
+
+    def plan(self, shape):
+        if shape not in self.plans:
+            a = pyfftw.empty_aligned(shape, numpy.complex64)
+            b = pyfftw.empty_aligned(shape, numpy.complex64)
+            self.plans[shape] = pyfftw.FFTW(a, b, axes=(1,), threads=self.threads,
+                                            flags=('FFTW_MEASURE',))
+            self.save_wisdom()
+        return self.plans[shape]
+
+    def fft(self, frames):
+        plan = self.plan(frames.shape)
+        plan.input_array[:] = frames
+        return plan()
+
+
+backends = {'numpy': NumpyFFT, 'scipy': ScipyFFT, 'pyfftw': FFTWBackend}
+
+
+def available():
+    names = ['numpy']
+    if scipy_fft is not None:
+        names.append('scipy')
+    if pyfftw is not None:
+        names.append('pyfftw')
+    return names
+
+
+def select(name='auto', threads=1):
+    """auto stays on numpy for a single thread, its complex128 result is the baseline
+    the others work in complex64, with threads auto prefers pyfftw, then scipy"""
+    if name == 'auto':
+        name = available()[-1] if threads > 1 else 'numpy'
+    if threads > 1 and name == 'numpy':
+        sys.stderr.write('warning: numpy fft is single threaded, --threads needs scipy or pyfftw\n')
+    if name not in available():
+        raise ValueError('fft back-end %s is not installed' % name)
+    return backends[name](max(1, threads))
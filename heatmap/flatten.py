@@ -1,52 +1,361 @@
 #! /usr/bin/env python
 
-import sys
-from collections import defaultdict
+import os, sys, argparse, functools
+import numpy
+import power_csv
+import sweep_store
+import instrument
+from power_csv import duration_parse
 
 # todo
-# interval based summary
-# tall vs wide vs super wide output
-
-def help():
-    print("flatten.py input.csv")
-    print("turns any rtl_power csv into a more compact summary")
-    sys.exit()
-
-if len(sys.argv) <= 1:
-    help()
-
-if len(sys.argv) > 2:
-    help()
-
-path = sys.argv[1]
-
-sums = defaultdict(float)
-counts = defaultdict(int)
-
-def frange(start, stop, step):
-    i = 0
-    f = start
-    while f <= stop:
-        f = start + step*i
-        yield f
-        i += 1
-
-for line in open(path):
-    line = line.strip().split(', ')
-    low = int(line[2])
-    high = int(line[3])
-    step = float(line[4])
-    weight = int(line[5])
-    dbm = [float(d) for d in line[6:]]
-    for f,d in zip(frange(low, high, step), dbm):
-        sums[f] += d*weight
-        counts[f] += weight
-
-ave = defaultdict(float)
-for f in sums:
-    ave[f] = sums[f] / counts[f]
-
-for f in sorted(ave):
-    print(','.join([str(f), str(ave[f])]))
-    
+# super wide output
 
+# percentiles come from a histogram of every bin, this wide in dB
+hist_resolution = 0.1
+# over this range, levels outside it land in an underflow or overflow bucket
+hist_floor = -80.0
+hist_ceiling = 40.0
+hist_buckets = int(round((hist_ceiling - hist_floor) / hist_resolution)) + 2
+
+def frange_size(low, high, step):
+    "how many bins the old frange() gave a hop, it ran one step past high"
+    return int((high - low) // step) + 2
+
+def parse_stats(text):
+    "'mean,max,p90' to a list of column names"
+    columns = [c.strip() for c in text.split(',') if c.strip()]
+    for c in columns:
+        if c in ('mean', 'min', 'max', 'count'):
+            continue
+        if c.startswith('p'):
+            try:
+                if 0 <= float(c[1:]) <= 100:
+                    continue
+            except ValueError:
+                pass
+        raise ValueError('unknown statistic %s' % c)
+    return columns
+
+class BinStats(object):
+    """running statistics of every frequency bin
+    each hop owns a slice of flat float64 arrays, levels land there by integer index
+    the histogram counts every level once, the sums and counts weigh it by its samples,
+    rtl_power uses one sample count per run so they only differ when runs are mixed"""
+
+    def __init__(self, histogram=False):
+        self.hops = {}
+        self.freqs = numpy.zeros(0)
+        self.sums = numpy.zeros(0)
+        self.counts = numpy.zeros(0)
+        self.mins = numpy.zeros(0)
+        self.maxs = numpy.zeros(0)
+        self.histogram = histogram
+        self.hist = numpy.zeros((0, hist_buckets), numpy.uint32)
+
+    def hop_base(self, key, freqs):
+        "first index of a hop, allocated the first time it shows up"
+        if key not in self.hops:
+            self.hops[key] = len(self.freqs)
+            n = len(freqs)
+            self.freqs = numpy.concatenate((self.freqs, freqs))
+            self.sums = numpy.concatenate((self.sums, numpy.zeros(n)))
+            self.counts = numpy.concatenate((self.counts, numpy.zeros(n)))
+            self.mins = numpy.concatenate((self.mins, numpy.full(n, numpy.inf)))
+            self.maxs = numpy.concatenate((self.maxs, numpy.full(n, -numpy.inf)))
+            if self.histogram:
+                self.hist = numpy.concatenate((self.hist, numpy.zeros((n, hist_buckets), numpy.uint32)))
+        return self.hops[key]
+
+    def add(self, idx, levels, weights):
+        "idx, levels and weights are flat and the same length"
+        if not len(idx):
+            return
+        size = len(self.freqs)
+        self.sums += numpy.bincount(idx, levels * weights, size)
+        self.counts += numpy.bincount(idx, weights, size)
+        numpy.minimum.at(self.mins, idx, levels)
+        numpy.maximum.at(self.maxs, idx, levels)
+        if self.histogram:
+            buckets = self.buckets(levels)
+            numpy.add.at(self.hist, (idx, buckets), 1)
+
+    def buckets(self, levels):
+        "histogram columns of the levels, 0 and the last one are underflow and overflow"
+        x = numpy.floor(levels / hist_resolution) - round(hist_floor / hist_resolution) + 1
+        return numpy.clip(x, 0, hist_buckets - 1).astype(numpy.int64)
+
+    def merge(self, other):
+        "adds the statistics of another BinStats, like the ones of a pool worker"
+        for key, other_base in other.hops.items():
+            other_end = min([b for b in other.hops.values() if b > other_base] + [len(other.freqs)])
+            n = other_end - other_base
+            base = self.hop_base(key, other.freqs[other_base:other_end])
+            mine = slice(base, base + n)
+            theirs = slice(other_base, other_end)
+            self.sums[mine] += other.sums[theirs]
+            self.counts[mine] += other.counts[theirs]
+            numpy.minimum(self.mins[mine], other.mins[theirs], out=self.mins[mine])
+            numpy.maximum(self.maxs[mine], other.maxs[theirs], out=self.maxs[mine])
+            if self.histogram:
+                self.hist[mine] += other.hist[theirs]
+
+    def add_chunk(self, chunk):
+        widths = numpy.diff(chunk.offsets)
+        keys = zip(chunk.low.tolist(), chunk.high.tolist(), chunk.step.tolist())
+        bases = []
+        sizes = []
+        for low, high, step in keys:
+            size = frange_size(low, high, step)
+            bases.append(self.hop_base((low, high, step), low + step * numpy.arange(size)))
+            sizes.append(size)
+        cols = numpy.arange(len(chunk.levels)) - numpy.repeat(chunk.offsets[:-1], widths)
+        keep = cols < numpy.repeat(sizes, widths)
+        idx = (numpy.repeat(numpy.array(bases, numpy.int64), widths) + cols)[keep]
+        weights = numpy.repeat(chunk.samples.astype(numpy.float64), widths)[keep]
+        self.add(idx, chunk.levels[keep], weights)
+
+    def add_store(self, store, start=0, stop=None):
+        "weighted by the sample count of each bin like the CSV lines, stores before version 2 weigh 1"
+        base = self.hop_base(('store', store.path), numpy.asarray(store.freqs, numpy.float64))
+        stop = len(store.times) if stop is None else stop
+        if store.samples is None:
+            samples = numpy.ones(len(store.freqs))
+        else:
+            samples = numpy.asarray(store.samples, numpy.float64)
+        for y in range(start, stop, 4096):
+            block = numpy.asarray(store.power[y:min(y + 4096, stop)], numpy.float64)
+            instrument.count(len(block), block.size * store.power.itemsize)
+            known = ~numpy.isnan(block)
+            cols = numpy.nonzero(known)[1]
+            self.add(cols + base, block[known], samples[cols])
+
+    def merged(self):
+        "bins of different hops on the same frequency (to 0.01 Hz) count as one"
+        used = self.counts > 0
+        keys, first, inverse = numpy.unique(numpy.round(self.freqs[used], 2),
+                                            return_index=True, return_inverse=True)
+        n = len(keys)
+        stats = {'freqs': self.freqs[used][first],
+                 'sums': numpy.bincount(inverse, self.sums[used], n),
+                 'counts': numpy.bincount(inverse, self.counts[used], n),
+                 'mins': numpy.full(n, numpy.inf),
+                 'maxs': numpy.full(n, -numpy.inf)}
+        numpy.minimum.at(stats['mins'], inverse, self.mins[used])
+        numpy.maximum.at(stats['maxs'], inverse, self.maxs[used])
+        if self.histogram:
+            rows = numpy.flatnonzero(used)[first]
+            if n < used.sum():
+                stats['hist'] = numpy.zeros((n, hist_buckets), numpy.uint32)
+                numpy.add.at(stats['hist'], inverse, self.hist[used])
+            elif numpy.array_equal(rows, numpy.arange(len(self.freqs))):
+                # nothing to merge or reorder, no copy
+                stats['hist'] = self.hist
+            else:
+                stats['hist'] = self.hist[rows]
+        return stats
+
+    def columns(self, names):
+        "frequencies and one array per statistic"
+        stats = self.merged()
+        out = []
+        for name in names:
+            if name == 'mean':
+                out.append(stats['sums'] / stats['counts'])
+            elif name == 'min':
+                out.append(stats['mins'])
+            elif name == 'max':
+                out.append(stats['maxs'])
+            elif name == 'count':
+                out.append(stats['counts'])
+            else:
+                out.append(self.percentile(stats['hist'], float(name[1:])))
+        return stats['freqs'], out
+
+    def percentile(self, hist, q):
+        "middle of the histogram bucket holding the q-th percentile, the range ends for the outer buckets"
+        bucket = numpy.zeros(len(hist), numpy.int64)
+        for y in range(0, len(hist), 4096):
+            cumulative = numpy.cumsum(hist[y:y + 4096], axis=1, dtype=numpy.int64)
+            target = numpy.maximum(numpy.ceil(cumulative[:, -1:] * q / 100.0), 1)
+            bucket[y:y + 4096] = (cumulative < target).sum(axis=1)
+        levels = hist_floor + (bucket - 0.5) * hist_resolution
+        return numpy.round(numpy.clip(levels, hist_floor, hist_ceiling), 2)
+
+def bucket_keys(epochs, interval):
+    if interval is None:
+        return numpy.zeros(len(epochs), numpy.int64)
+    return numpy.asarray(epochs, numpy.int64) // interval * interval
+
+def runs(keys):
+    "[start, stop) of every run of equal keys"
+    cuts = [0] + (numpy.flatnonzero(numpy.diff(keys)) + 1).tolist() + [len(keys)]
+    return zip(cuts, cuts[1:])
+
+def csv_runs(path, interval, start=0, stop=None):
+    "(bucket, feed) for every run of lines in one bucket, feed adds them to a BinStats"
+    for chunk in power_csv.read_chunks(path, start=start, stop=stop):
+        epochs = {}
+        if interval is not None:
+            epochs = dict((t, power_csv.time_to_epoch(t)) for t in set(chunk.times))
+        keys = bucket_keys([epochs.get(t, 0) for t in chunk.times], interval)
+        for a, b in runs(keys):
+            yield int(keys[a]), functools.partial(BinStats.add_chunk, chunk=power_csv.chunk_slice(chunk, a, b))
+
+def store_runs(store, interval, start=0, stop=None):
+    """same for rows [start, stop) of a sweep store"""
+    stop = len(store.times) if stop is None else stop
+    keys = bucket_keys(store.times[start:stop], interval)
+    for a, b in runs(keys):
+        yield int(keys[a]), functools.partial(BinStats.add_store, store=store, start=start + a, stop=start + b)
+
+def bucket_stats(path, names, interval=None, start=0, stop=None):
+    """yields (bucket start epoch, BinStats) in time order, only the current bucket is kept
+    without an interval the whole file is one bucket
+    start and stop are byte offsets in a CSV, rows in a sweep store"""
+    histogram = any(n.startswith('p') for n in names)
+    if sweep_store.is_store(path):
+        feeds = store_runs(sweep_store.SweepStore(path), interval, start, stop)
+    else:
+        feeds = csv_runs(path, interval, start, stop)
+    start, stats = None, None
+    for bucket, feed in feeds:
+        # late lines go to the current bucket
+        if stats is None or bucket > start:
+            if stats is not None:
+                yield start, stats
+            start, stats = bucket, BinStats(histogram)
+        feed(stats)
+    if stats is not None:
+        yield start, stats
+
+def file_parts(paths, jobs):
+    """(path, start, stop) pieces for the pool
+    plain CSV files are cut on line boundaries, indexed gzip on members, stores by rows,
+    plain gzip goes whole"""
+    for path in paths:
+        if jobs > 1 and sweep_store.is_store(path):
+            rows = len(sweep_store.SweepStore(path).times)
+            cuts = [rows * i // (jobs * 4) for i in range(jobs * 4 + 1)]
+            for a, b in zip(cuts, cuts[1:]):
+                if a < b:
+                    yield path, a, b
+        elif jobs > 1 and power_csv.splittable(path):
+            for a, b in power_csv.byte_ranges(path, jobs * 4):
+                yield path, a, b
+        else:
+            yield path, 0, None
+
+def part_stats(part):
+    """every bucket of one piece, runs in the pool"""
+    path, start, stop, names, interval = part
+    return list(bucket_stats(path, names, interval, start, stop))
+
+def pooled_stats(paths, names, interval=None, jobs=1):
+    """(bucket, BinStats) of many files or pieces, merged by bucket
+    unlike bucket_stats every bucket stays in memory until the end"""
+    # without fork (windows) the pieces are reduced in this process
+    context = instrument.fork_context() if jobs > 1 else None
+    parts = [part + (names, interval) for part in file_parts(paths, jobs)]
+    merged = {}
+    pool = context.Pool(jobs) if context else None
+    try:
+        results = pool.imap(part_stats, parts) if pool else map(part_stats, parts)
+        for result in results:
+            instrument.tick()
+            for bucket, stats in result:
+                if bucket in merged:
+                    merged[bucket].merge(stats)
+                else:
+                    merged[bucket] = stats
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return sorted(merged.items())
+
+def summarize(path, names):
+    for start, stats in bucket_stats(path, names):
+        return stats.columns(names)
+    return numpy.zeros(0), [numpy.zeros(0) for n in names]
+
+def write_rows(freqs, columns, out=sys.stdout, label=None):
+    rows = zip(freqs.tolist(), *[c.tolist() for c in columns])
+    if label is not None:
+        rows = ((row[0], label) + row[1:] for row in rows)
+    out.writelines(','.join(map(str, row)) + '\n' for row in rows)
+
+def write_tall(buckets, names, out=sys.stdout):
+    "freq,time,stats... for every bin of every bucket"
+    for start, stats in buckets:
+        freqs, columns = stats.columns(names)
+        write_rows(freqs, columns, out, power_csv.epoch_to_time(start))
+
+def write_wide(buckets, names, out=sys.stdout):
+    "a header of frequencies, then time,levels... for every bucket"
+    header = None
+    for start, stats in buckets:
+        freqs, columns = stats.columns(names)
+        keys = numpy.round(freqs, 2)
+        if header is None:
+            header = keys
+            out.write(','.join(['time'] + list(map(str, freqs.tolist()))) + '\n')
+        # bins missing from the first bucket have no column, empty cells for the others
+        cells = [''] * len(header)
+        x = numpy.searchsorted(header, keys)
+        found = (x < len(header)) & (header[numpy.minimum(x, len(header) - 1)] == keys)
+        for i, z in zip(x[found].tolist(), columns[0][found].tolist()):
+            cells[i] = str(z)
+        out.write(','.join([power_csv.epoch_to_time(start)] + cells) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Turns any rtl_power csv into a more compact summary.')
+    parser.add_argument('paths', metavar='INPUT', type=str, nargs='+',
+                        help='Input CSV files, all summed together. (may be .csv.gz or sweep stores)')
+    parser.add_argument('--stats', dest='stats', default='mean',
+                        help='Comma separated columns after the frequency: mean, min, max, count, pNN. (default mean)')
+    parser.add_argument('--interval', dest='interval', default=None,
+                        help='One summary per time bucket of this duration, like 10m or 1h.')
+    parser.add_argument('--format', dest='format', default='tall', choices=['tall', 'wide'],
+                        help='With --interval, tall gives freq,time,stats rows, wide one row of levels per bucket.')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help='Reduce files and pieces of large files with N processes.')
+    parser.add_argument('--run-stats', dest='run_stats', default=None, choices=['json', 'text'],
+                        help='Timings, lines read and peak memory on stderr at the end, progress every few seconds.')
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help='Profile the run into this file, .html or .txt use pyinstrument, else a cProfile dump.')
+    args = parser.parse_args()
+    if args.run_stats:
+        instrument.enable(args.run_stats)
+    if args.profile:
+        instrument.start_profile(args.profile)
+    try:
+        names = parse_stats(args.stats)
+    except ValueError as e:
+        parser.error(str(e))
+    interval = None
+    if args.interval is not None:
+        interval = int(duration_parse(args.interval))
+        if interval < 1:
+            parser.error('--interval must be at least a second')
+    elif args.format == 'wide':
+        parser.error('--format wide needs --interval')
+
+    if args.format == 'wide' and len(names) != 1:
+        parser.error('--format wide takes a single statistic')
+
+    # buckets are lazy, the phase covers reading and writing
+    plain = [p for p in args.paths if not p.endswith('.gz') and not sweep_store.is_store(p)]
+    total = sum(map(os.path.getsize, plain)) if len(plain) == len(args.paths) else None
+    with instrument.phase('flatten', total):
+        if len(args.paths) == 1 and args.jobs < 2:
+            buckets = bucket_stats(args.paths[0], names, interval)
+        else:
+            buckets = pooled_stats(args.paths, names, interval, args.jobs)
+        if interval is None:
+            for start, stats in buckets:
+                freqs, columns = stats.columns(names)
+                write_rows(freqs, columns)
+        elif args.format == 'wide':
+            write_wide(buckets, names)
+        else:
+            write_tall(buckets, names)
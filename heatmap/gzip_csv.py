@@ -0,0 +1,22 @@
+#! /usr/bin/env python
+
+"""
+recompress an rtl_power csv (or csv.gz) into an indexed gzip
+zcat and gzip.open read it as usual, heatmap.py and flatten.py can also
+seek in it for --begin/--end and split it over --jobs
+"""
+
+import argparse
+import power_csv
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compress rtl_power CSV files into a seekable multi-member gzip.')
+    parser.add_argument('input_path', metavar='INPUT', type=str,
+                        help='Input CSV file. (may be a .csv.gz)')
+    parser.add_argument('output_path', metavar='OUTPUT', type=str,
+                        help='Output .csv.gz file.')
+    parser.add_argument('--member-size', dest='member_size', type=float, default=power_csv.member_bytes / 2.0 ** 20,
+                        help='Uncompressed MB per gzip member, the unit of seeking. (default 4)')
+    args = parser.parse_args()
+    power_csv.write_gzip(power_csv.read_lines(args.input_path), args.output_path, int(args.member_size * 2 ** 20))
+    print("wrote %i members" % len(power_csv.gzip_members(args.output_path)))
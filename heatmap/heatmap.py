@@ -1,9 +1,15 @@
 #! /usr/bin/env python
 
 import os
-import json
 from PIL import Image, ImageDraw, ImageFont
-import sys, gzip, math, argparse, colorsys, datetime
+import sys, argparse, datetime
+import struct, tempfile, time, bisect, functools, shlex, collections
+import numpy
+import power_csv
+from power_csv import duration_parse, load_jsonfile
+import sweep_store
+import tiles
+import instrument
 
 # Version
 # Add --parameters feature
@@ -26,6 +32,169 @@ HzUnities = {'M': 1e6, 'k': 1e3}
 secUnities = {'s': 1, 'm': 60, 'h': 3600}
 
 
+class SweepSpool(object):
+    """parsed hop lines, spills to disk past max_size
+    rtl_power writes %.2f levels, int16 centi-dB keeps them exactly in a quarter of float64"""
+    header = struct.Struct('<HdI')
+
+    def __init__(self, max_size):
+        self.fd = tempfile.SpooledTemporaryFile(max_size=max_size)
+
+    def append(self, t, freq, zs):
+        t = t.encode('ascii')
+        self.fd.write(self.header.pack(len(t), freq, len(zs)))
+        self.fd.write(t)
+        centi = numpy.clip(numpy.round(numpy.asarray(zs) * 100), -32768, 32767)
+        self.fd.write(centi.astype('<i2').tobytes())
+
+    def __iter__(self):
+        self.fd.seek(0)
+        read = self.fd.read
+        size = self.header.size
+        while True:
+            head = read(size)
+            if len(head) < size:
+                break
+            t_len, freq, count = self.header.unpack(head)
+            t = read(t_len).decode('ascii')
+            yield t, freq, numpy.frombuffer(read(2 * count), '<i2') / 100.0
+        self.fd.seek(0, os.SEEK_END)
+
+
+class Waterfall(object):
+    """full resolution power levels, NaN where no sample landed
+    float64 like the parsed levels, float32 rounding moves some pixels a colour level
+    top shifts the rows, for the strips drawn by the pool workers"""
+
+    mergeable = True
+
+    def __init__(self, height, width, top=0):
+        self.top = top
+        self.pixels = numpy.full((height, width), numpy.nan)
+        self.shape = self.pixels.shape
+
+    def add(self, y, x, zs):
+        row = self.pixels[y - self.top, x:x + len(zs)]
+        row[:] = zs[:len(row)]
+
+    def add_block(self, y, block):
+        self.pixels[y - self.top:y - self.top + len(block)] = block
+
+    def strip(self, top, bottom):
+        return Waterfall(bottom - top, self.shape[1], top)
+
+    def grow(self, rows):
+        extra = numpy.full((rows, self.shape[1]), numpy.nan)
+        self.pixels = numpy.concatenate((self.pixels, extra))
+        self.shape = self.pixels.shape
+
+    def drop(self, rows):
+        self.pixels = self.pixels[rows:].copy()
+        self.shape = self.pixels.shape
+
+    def merge(self, strip):
+        """later samples win, like the serial loop"""
+        dest = self.pixels[strip.top - self.top:strip.top - self.top + strip.shape[0]]
+        numpy.copyto(dest, strip.pixels, where=~numpy.isnan(strip.pixels))
+
+    def result(self):
+        return self.pixels
+
+
+class Downsampler(object):
+    """aggregates a (height x width) waterfall into out_h x out_w pixels while streaming
+    memory follows the output size, percentile buffers the samples of the pixel rows
+    still being filled and reduces a row once the stream moved past it"""
+
+    def __init__(self, height, width, out_h, out_w, how='mean', q=50):
+        self.rows = numpy.arange(height) * out_h // height
+        self.cols = numpy.arange(width) * out_w // width
+        self.shape = (out_h, out_w)
+        self.geometry = (height, width, out_h, out_w, how, q)
+        self.how = how
+        self.q = q
+        # percentile rows split across strips would not be exact
+        self.mergeable = how != 'percentile'
+        if how == 'mean':
+            self.sums = numpy.zeros(self.shape)
+            self.counts = numpy.zeros(self.shape)
+        elif how == 'max':
+            self.maxs = numpy.full(self.shape, -numpy.inf)
+        else:
+            self.pixels = numpy.full(self.shape, numpy.nan)
+            self.pending = {}
+            self.finished = 0  # pixel rows above this one are reduced
+            self.late = 0
+
+    def add(self, y, x, zs):
+        zs = numpy.asarray(zs[:len(self.cols) - x], numpy.float64)
+        cols = self.cols[x:x + len(zs)]
+        known = ~numpy.isnan(zs)
+        if not known.all():
+            zs = zs[known]
+            cols = cols[known]
+        if not len(zs):
+            return
+        oy = self.rows[y]
+        if self.how == 'percentile':
+            self.buffer(oy, cols, zs)
+            return
+        starts = numpy.flatnonzero(numpy.diff(cols, prepend=-1))
+        ox = cols[starts]
+        if self.how == 'mean':
+            self.sums[oy, ox] += numpy.add.reduceat(zs, starts)
+            self.counts[oy, ox] += numpy.diff(numpy.append(starts, len(zs)))
+        else:
+            self.maxs[oy, ox] = numpy.fmax(self.maxs[oy, ox], numpy.maximum.reduceat(zs, starts))
+
+    def add_block(self, y, block):
+        for i, zs in enumerate(block):
+            self.add(y + i, 0, zs)
+
+    def buffer(self, oy, cols, zs):
+        """keeps the samples until their pixel row is done, the row before the
+        current one stays open for the last hops of a sweep"""
+        if oy < self.finished:
+            # out of order input, the pixels of that row are already final
+            if not self.late:
+                power_csv.warn('sweeps out of time order, samples of finished pixel rows are left out')
+            self.late += len(zs)
+            return
+        self.pending.setdefault(oy, []).append((cols, zs))
+        if oy - 1 > self.finished:
+            self.finished = oy - 1
+            for r in [r for r in self.pending if r < self.finished]:
+                self.flush(r)
+
+    def flush(self, r):
+        """the percentile of every pixel of a row, over all of its samples at once"""
+        parts = self.pending.pop(r)
+        cols, levels = group_percentile(numpy.concatenate([p[0] for p in parts]),
+                                        numpy.concatenate([p[1] for p in parts]), self.q)
+        self.pixels[r, cols] = levels
+
+    def strip(self, top, bottom):
+        return Downsampler(*self.geometry)
+
+    def merge(self, strip):
+        if self.how == 'mean':
+            self.sums += strip.sums
+            self.counts += strip.counts
+        else:
+            numpy.fmax(self.maxs, strip.maxs, out=self.maxs)
+
+    def result(self):
+        if self.how == 'mean':
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                return self.sums / self.counts
+        if self.how == 'max':
+            return numpy.where(numpy.isinf(self.maxs), numpy.nan, self.maxs)
+        for r in list(self.pending):
+            self.flush(r)
+        self.finished = self.shape[0]
+        return self.pixels
+
+
 class HeatmapGenerator(object):
     fontsize = 10
     font = None
@@ -34,14 +203,10 @@ class HeatmapGenerator(object):
     legend_line_height = 8
     legend_line_space = 10
     max_nb_lines_legend = 5
-    legends_row = []
     waterwall_width, waterwall_height = 0, 0
-    waterwall_height = 0
     tape_pt = 10
     min_z = 100
     max_z = -100
-    freqs = set()
-    times = set()
     freq_left, freq_right = 0, 0
     timestart, timestop, step = None, None, None
     low_freq, high_freq = None, None
@@ -49,33 +214,90 @@ class HeatmapGenerator(object):
     time_tick = None
     db_limit_isset = False
     img = None
+    waterfall = None
+    colors = None
+    max_width, max_height = None, None
+    live = False
+    tile_format = None
+    downsample, percentile = 'mean', 50
+    x_scale = 1.0
+    raster_rows = 1024
     csv_path, png_path = "", ""
-    texts = []
     img_width, img_height = 0, 0
     heatmap_parameters = None
-    texts = []
+    single_pass = False
+    spool_size = 256 * 2 ** 20
+    spool = None
+    store = None
+    store_rows, store_cols = None, None
+    table = None
+    jobs = 1
+    begin_time, end_time, head_time, tail_time = None, None, None, None
+    begin_t, end_t = None, None
+    byte_span = (0, None)
 
     def __init__(self, ):
+        # Per render state, several generators can live in one process
+        self.freqs = []
+        self.times = []
+        self.freq_index = {}
+        self.time_index = {}
+        self.legends_row = []
+        self.texts = []
         try:
-            self.font = ImageFont.truetype("Vera.ttf", self.fontsize)
+            self.font = load_font(self.fontsize)
         except IOError:
-            print('Please download the Vera.ttf font and place it in the current directory.')
-            sys.exit(1)
+            raise IOError('Please download the Vera.ttf font and place it in the current directory.')
 
     # Init image object
     def init_heatmap(self):
-        self.waterwall_width = len(self.freqs)
-        self.waterwall_height = len(self.times)
+        height, width = len(self.times), len(self.freqs)
+        out_w = min(width, self.max_width or width)
+        out_h = min(height, self.max_height or height)
+        self.waterwall_width = out_w
+        self.waterwall_height = out_h
+        self.new_image()
+
+        # Power levels by (time, freq), aggregated when over the size limits
+        if (out_h, out_w) == (height, width):
+            self.waterfall = Waterfall(height, width)
+            return
+        self.waterfall = Downsampler(height, width, out_h, out_w, self.downsample, self.percentile)
+
+        # The labels follow the first bin and sweep of every pixel
+        self.x_scale = width / float(out_w)
+        self.freqs = [self.freqs[x] for x in numpy.searchsorted(self.waterfall.cols, range(out_w))]
+        self.times = [self.times[y] for y in numpy.searchsorted(self.waterfall.rows, range(out_h))]
 
+    def new_image(self):
         self.img_width = self.waterwall_width
         self.img_height = self.tape_height + self.waterwall_height + self.legends_height
         self.img = Image.new("RGB", (self.img_width, self.img_height))
 
-    # Save image object to file
+    # Save image object to file, or a tile pyramid in that folder
     def save(self, filename):
+        if self.tile_format:
+            return self.save_tiles(filename)
         print("saving")
         self.img.save(filename)
 
+    def save_tiles(self, path):
+        print("tiling")
+        info = {'freq_left': self.freq_left, 'freq_right': self.freq_right + self.step,
+                'time_start': self.times[0], 'time_stop': self.times[-1]}
+        tiles.TilePyramid(path, self.rgb2, self.tile_format).write(self.waterfall.result(), self.tape_image, info)
+
+    # The frequency tape alone at another width, labelled for the zoom levels of the tiles
+    def tape_image(self, width):
+        img, freqs = self.img, self.freqs
+        self.img = Image.new("RGB", (width, self.tape_height))
+        self.freqs = [freqs[x] for x in numpy.arange(width) * len(freqs) // width]
+        try:
+            self.draw_tape()
+            return self.img
+        finally:
+            self.img, self.freqs = img, freqs
+
     # Set heatmap parameters from JSON file
     def set_heatmap_parameters(self, content):
         self.heatmap_parameters = content
@@ -91,79 +313,114 @@ class HeatmapGenerator(object):
         self.min_z = min(min_z, max_z)
         self.max_z = max(min_z, max_z)
 
-    # Calc power db level color
-    def rgb2(self, z):
-        g = (z - self.min_z) / (self.max_z - self.min_z)
+    # Calc power db level colors, for a whole array of levels at once
+    def rgb2(self, zs):
+        zs = numpy.asarray(zs, numpy.float64)
+        known = ~numpy.isnan(zs)
+        g = (numpy.where(known, zs, self.min_z) - self.min_z) / (self.max_z - self.min_z)
+        # int() truncates and PIL clamps
+        level = numpy.clip(numpy.trunc(g * 255), 0, 255).astype(numpy.uint8)
+        level[~known] = 0
+        rgb = numpy.empty(zs.shape + (3,), numpy.uint8)
+        rgb[..., 0] = level
+        rgb[..., 1] = level
+        rgb[..., 2] = numpy.where(known, 50, 0)
         if self.heatmap_parameters and 'db' in self.heatmap_parameters and 'mean' in self.heatmap_parameters['db']:
-            if z > self.heatmap_parameters['db']['mean']:
-                return int(g * 255), int(g * 255), 50
-            else:
-                return int(g * 255), 0, 0
+            dark = known & ~(zs > self.heatmap_parameters['db']['mean'])
+            rgb[..., 1][dark] = 0
+            rgb[..., 2][dark] = 0
 
-        return int(g * 255), int(g * 255), 50
+        return rgb
 
     def slice_columns(self, columns, low, high):
         start_col = 0
         stop_col = len(columns)
         if self.low_freq is not None and low <= self.low_freq <= high:
-            start_col = sum(f < args.low_freq for f in columns)
+            start_col = sum(f < self.low_freq for f in columns)
         if self.high_freq is not None and low <= self.high_freq <= high:
-            stop_col = sum(f <= args.high_freq for f in columns)
+            stop_col = sum(f <= self.high_freq for f in columns)
         return start_col, stop_col - 1
 
-    # Compute the CSV datas summary
+    # Iterate the (time, span key, levels) of every hop line inside the slice
+    def parse_hops(self, filename, start=None, stop=None):
+        if start is None:
+            start, stop = self.byte_span
+        spans = {}
+        for chunk in power_csv.read_chunks(filename, start=start, stop=stop):
+            # the filters run on whole chunks, only the lines left are walked
+            keep = numpy.ones(len(chunk.times), bool)
+            if self.begin_t is not None or self.end_t is not None:
+                times = numpy.array(chunk.times)
+                if self.begin_t is not None:
+                    keep &= times >= self.begin_t
+                if self.end_t is not None:
+                    keep &= times <= self.end_t
+            if keep.any():
+                self.step = chunk.step[keep][-1].item()
+            lows = chunk.low + self.offset_freq
+            highs = chunk.high + self.offset_freq
+            if self.low_freq is not None:
+                keep &= highs >= self.low_freq
+            if self.high_freq is not None:
+                keep &= lows <= self.high_freq
+            lows = lows.tolist()
+            highs = highs.tolist()
+            steps = chunk.step.tolist()
+            offsets = chunk.offsets.tolist()
+            for i in numpy.flatnonzero(keep).tolist():
+                key = (lows[i], highs[i], steps[i])
+                span = spans.get(key)
+                if span is None:
+                    columns = list(power_csv.frange(*key))
+                    start_col, stop_col = self.slice_columns(columns, key[0], key[1])
+                    span = (start_col, stop_col, (columns[start_col], columns[stop_col], key[2]))
+                    spans[key] = span
+                start_col, stop_col, f_key = span
+                zs = chunk.levels[offsets[i] + start_col:min(offsets[i] + stop_col + 1, offsets[i + 1])]
+                if len(zs):
+                    yield chunk.times[i], f_key, zs
+
+    # Compute the CSV or sweep store datas summary
     def calc_summary(self, filename):
-        self.freqs = set()
-        f_cache = set()
-        self.times = set()
-
-        # Create a loader function
-        raw_data = lambda: open(filename)
-        if filename.endswith('.gz'):
-            raw_data = lambda: gzip_wrap(filename)
-
-        # Load CSV datas
-        print("loading")
-        for line in raw_data():
-            line = [s.strip() for s in line.strip().split(',')]
-            # line = [line[0], line[1]] + [float(s) for s in line[2:] if s]
-            line = [s for s in line if s]
-
-            low = int(line[2]) + self.offset_freq
-            high = int(line[3]) + self.offset_freq
-            self.step = float(line[4])
-            if self.low_freq is not None and high < self.low_freq:
-                continue
-            if self.high_freq is not None and self.high_freq < low:
-                continue
-            columns = list(frange(low, high, self.step))
-            start_col, stop_col = self.slice_columns(columns, low, high)
-            f_key = (columns[start_col], columns[stop_col], self.step)
-            zs = line[6 + start_col:6 + stop_col + 1]
-            if f_key not in f_cache:
-                freq2 = list(frange(*f_key))[:len(zs)]
-                self.freqs.update(freq2)
-                f_cache.add(f_key)
-
-            t = line[0] + ' ' + line[1]
-            self.times.add(t)
-
-            if not self.db_limit_isset:
-                zs = floatify(zs)
-                self.min_z = min(self.min_z, min(zs))
-                self.max_z = max(self.max_z, max(zs))
-
-                # if self.timestart is None:
-                # self.timestart = parse_time(line[0] + ' ' + line[1])
-                # self.timestop = parse_time(line[0] + ' ' + line[1])
-
+        self.store = None
+        self.table = None
+        if sweep_store.is_store(filename):
+            self.store = sweep_store.SweepStore(filename)
+        self.slice_times(filename)
+        instrument.expect(self.span_bytes(filename))
+        if self.store is not None:
+            self.calc_store_summary(filename)
+        else:
+            self.calc_csv_summary(filename)
+        self.index_axes()
+
+    # Take a ready (time x freq) table of levels, like the raw_iq.py PSD rows
+    def calc_table_summary(self, levels, freqs, times):
+        self.store = None
+        self.table = levels
+        self.freqs = [f + self.offset_freq for f in freqs]
+        self.times = list(times)
+        self.step = freqs[1] - freqs[0] if len(freqs) > 1 else 0
+        if not self.db_limit_isset:
+            finite = numpy.isfinite(levels)
+            if finite.any():
+                self.min_z = min(self.min_z, float(levels.min(where=finite, initial=numpy.inf)))
+                self.max_z = max(self.max_z, float(levels.max(where=finite, initial=-numpy.inf)))
+        self.index_axes()
+
+    # Sorted axes and their lookups
+    def index_axes(self):
+        if not self.freqs or not self.times:
+            raise ValueError('no sweeps in range')
         # Store freqs informations
         self.freqs = list(sorted(list(self.freqs)))
         self.freq_left = self.freqs[0]
         self.freq_right = self.freqs[-1]
+        self.freq_index = dict((f, x) for x, f in enumerate(self.freqs))
 
         # Store time informations
         self.times = list(sorted(list(self.times)))
+        self.time_index = dict((t, y) for y, t in enumerate(self.times))
         self.timestart = parse_time(self.times[0])
         self.timestop = parse_time(self.times[-1])
 
@@ -171,35 +428,323 @@ class HeatmapGenerator(object):
             self.freq_left / 1e6, self.freq_right / 1e6, self.timestart, self.timestop))
         print("Img info: x: %i, y: %i, z: (%f, %f)" % (len(self.freqs), len(self.times), self.min_z, self.max_z))
 
+    # Turn --begin/--end/--head/--tail into timestamp bounds and a byte span
+    def slice_times(self, filename):
+        self.begin_t, self.end_t = None, None
+        self.byte_span = (0, None)
+        if self.begin_time is None and self.end_time is None and \
+                self.head_time is None and self.tail_time is None:
+            self.clip_live(filename)
+            return
+
+        # The sidecar index gives the file bounds and where to seek
+        index = None
+        if self.store is not None:
+            first, last = int(self.store.times[0]), int(self.store.times[-1])
+        elif power_csv.splittable(filename):
+            index = power_csv.SweepIndex(filename)
+            first, last = index.first_epoch(), index.last_epoch
+        else:
+            first, last = power_csv.time_bounds(filename)
+
+        # Without --end or --head the end stays open, --follow keeps taking new sweeps
+        begin = first if self.begin_time is None else power_csv.time_to_epoch(self.begin_time)
+        end = None if self.end_time is None else power_csv.time_to_epoch(self.end_time)
+        if self.head_time is not None:
+            end = begin + self.head_time if end is None else min(end, begin + self.head_time)
+        if self.tail_time is not None:
+            begin = max(begin, (last if end is None else end) - self.tail_time)
+        if begin > last or (end is not None and (begin > end or end < first)):
+            raise ValueError('no sweeps in range')
+        self.begin_t = power_csv.epoch_to_time(begin)
+        self.end_t = None if end is None else power_csv.epoch_to_time(end)
+        if index is not None:
+            self.byte_span = index.seek_range(begin, end)
+        self.clip_live(filename)
+
+    # Bytes of plain CSV to parse, for the progress ETA
+    def span_bytes(self, filename):
+        if self.store is not None or filename.endswith('.gz'):
+            return None
+        start, stop = self.byte_span
+        return (os.path.getsize(filename) if stop is None else stop) - start
+
+    # rtl_power may be halfway through the last line of a live file
+    def clip_live(self, filename):
+        if self.live:
+            start, stop = self.byte_span
+            end = power_csv.complete_size(filename)
+            self.byte_span = (start, end if stop is None else min(stop, end))
+
+    # Memory-map a sweep store, only the sliced rows and columns get read
+    def calc_store_summary(self, filename):
+        print("loading")
+        low = None if self.low_freq is None else self.low_freq - self.offset_freq
+        high = None if self.high_freq is None else self.high_freq - self.offset_freq
+        c0, c1 = self.store.col_range(low, high)
+        self.store_cols = (c0, c1)
+        self.step = self.store.hops[-1][2]
+
+        # Drop the sweeps without a sample in the slice, like the CSV loader
+        r0, r1 = 0, len(self.store.times)
+        if self.begin_t is not None:
+            end = None if self.end_t is None else power_csv.time_to_epoch(self.end_t)
+            r0, r1 = self.store.row_range(power_csv.time_to_epoch(self.begin_t), end)
+        rows = [numpy.zeros(0, numpy.int64)]
+        for y in range(r0, r1, 4096):
+            y2 = min(y + 4096, r1)
+            block = numpy.asarray(self.store.power[y:y2, c0:c1], numpy.float64)
+            known = ~numpy.isnan(block)
+            rows.append(numpy.flatnonzero(known.any(axis=1)) + y)
+            if not self.db_limit_isset and known.any():
+                self.min_z = min(self.min_z, float(block[known].min()))
+                self.max_z = max(self.max_z, float(block[known].max()))
+        self.store_rows = numpy.concatenate(rows)
+
+        self.freqs = (self.store.freqs[c0:c1] + self.offset_freq).tolist()
+        times = self.store.times[self.store_rows].tolist()
+        self.times = [power_csv.epoch_to_time(e) for e in times]
+
+    def calc_csv_summary(self, filename):
+        self.freqs = set()
+        self.times = set()
+
+        # Keep the parsed lines, draw_heatmap replays them instead of the CSV
+        self.spool = None
+        if self.single_pass and not self.use_pool(filename):
+            self.spool = SweepSpool(self.spool_size)
+
+        # Load CSV datas, a batch may render the same file more than once
+        key = self.summary_key(filename)
+        summaries = summary_cache.get(key)
+        if summaries is not None:
+            summary_cache.move_to_end(key)
+        elif self.use_pool(filename):
+            print("loading")
+            summaries = self.pool_map(summary_band, filename)
+        else:
+            print("loading")
+            summaries = [self.summarize(filename)]
+        if key is not None:
+            summary_cache[key] = summaries
+            while len(summary_cache) > summary_cache_size:
+                summary_cache.popitem(last=False)
+        for times, freqs, min_z, max_z, step in summaries:
+            self.times.update(times)
+            self.freqs.update(freqs)
+            self.min_z = min(self.min_z, min_z)
+            self.max_z = max(self.max_z, max_z)
+            self.step = step
+
+    # Everything the axes and level range depend on, None when not cacheable
+    def summary_key(self, filename):
+        if self.spool is not None or self.live:
+            return None
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_size, stat.st_mtime, self.byte_span,
+                self.begin_t, self.end_t, self.low_freq, self.high_freq, self.offset_freq,
+                self.db_limit_isset, self.min_z, self.max_z)
+
+    # Axes and level range of a byte range of the CSV
+    def summarize(self, filename, start=0, stop=None):
+        freqs = set()
+        f_cache = set()
+        times = set()
+        min_z, max_z = self.min_z, self.max_z
+        for t, f_key, zs in self.parse_hops(filename, start, stop):
+            if f_key not in f_cache:
+                freq2 = list(power_csv.frange(*f_key))[:len(zs)]
+                freqs.update(freq2)
+                f_cache.add(f_key)
+
+            times.add(t)
+
+            if self.spool is not None:
+                self.spool.append(t, f_key[0], zs)
+            if not self.db_limit_isset:
+                min_z = min(min_z, float(zs.min()))
+                max_z = max(max_z, float(zs.max()))
+
+                # if self.timestart is None:
+                # self.timestart = parse_time(line[0] + ' ' + line[1])
+                # self.timestop = parse_time(line[0] + ' ' + line[1])
+        return times, freqs, min_z, max_z, self.step
+
+    # Bands of the file go to forked workers, plain gzip can not be split
+    # and without fork (windows) the jobs run serially
+    def use_pool(self, filename):
+        return self.jobs > 1 and power_csv.splittable(filename) and instrument.fork_context() is not None
+
+    def pool_map(self, worker, filename):
+        global pool_generator
+        pool_generator = self
+        bands = [(filename, start, stop) for start, stop in power_csv.byte_ranges(filename, self.jobs * 4, *self.byte_span)]
+        pool = instrument.fork_context().Pool(self.jobs)
+        try:
+            results = []
+            for result in pool.imap(worker, bands):
+                results.append(result)
+                instrument.tick()
+            return results
+        finally:
+            pool.close()
+            pool.join()
+            pool_generator = None
+
+    # Iterate the (time, first freq, levels) of every hop line
+    def hop_rows(self, filename):
+        if self.store is not None:
+            return
+        if self.spool is not None:
+            for row in self.spool:
+                yield row
+            return
+
+        for t, f_key, zs in self.parse_hops(filename):
+            yield t, f_key[0], zs
 
     # Draw the rtl_power signal result
     def draw_heatmap(self, filename):
-        # Create a loader function
-        raw_data = lambda: open(filename)
-        if filename.endswith('.gz'):
-            raw_data = lambda: gzip_wrap(filename)
-
-        pix = self.img.load()
         print("drawing")
-        for line in raw_data():
-            line = [s.strip() for s in line.strip().split(',')]
-            # line = [line[0], line[1]] + [float(s) for s in line[2:] if s]
-            line = [s for s in line if s]
-            t = line[0] + ' ' + line[1]
-            if t not in self.times:
-                continue  # happens with live files
-            y = self.times.index(t)
-            low = int(line[2]) + self.offset_freq
-            high = int(line[3]) + self.offset_freq
-            columns = list(frange(low, high, self.step))
-            start_col, stop_col = self.slice_columns(columns, low, high)
-            x_start = self.freqs.index(columns[start_col])
-            zs = floatify(line[6 + start_col:6 + stop_col + 1])
-            for idx in range(len(zs)):
-                x = x_start + idx
-                if x >= self.img_width:
-                    continue
-                pix[x, y + self.tape_height] = self.rgb2(zs[idx])
+        if self.store is not None:
+            c0, c1 = self.store_cols
+            for y in range(0, len(self.store_rows), self.raster_rows):
+                rows = self.store_rows[y:y + self.raster_rows]
+                self.waterfall.add_block(y, self.store.power[rows, c0:c1])
+
+        if self.store is None and self.use_pool(filename) and self.waterfall.mergeable:
+            for strip in self.pool_map(draw_band, filename):
+                if strip is not None:
+                    self.waterfall.merge(strip)
+        else:
+            for t, freq, zs in self.hop_rows(filename):
+                y = self.time_index.get(t)
+                if y is None:
+                    continue  # happens with live files
+                self.waterfall.add(y, self.freq_index[freq], zs)
+
+        self.paint_heatmap()
+
+    # Same for a table given to calc_table_summary
+    def draw_table(self):
+        print("drawing")
+        for y in range(0, len(self.table), self.raster_rows):
+            self.waterfall.add_block(y, self.table[y:y + self.raster_rows])
+        self.paint_heatmap()
+
+    # Color by bands of rows, keeps the temporaries small
+    def paint_heatmap(self):
+        levels = self.waterfall.result()
+        for y in range(0, self.waterwall_height, self.raster_rows):
+            band = self.rgb2(levels[y:y + self.raster_rows])
+            self.img.paste(Image.fromarray(band), (0, y + self.tape_height))
+
+    # Rasterize a byte range of the CSV into a strip of rows
+    def draw_strip(self, filename, start, stop):
+        hops = []
+        for t, f_key, zs in self.parse_hops(filename, start, stop):
+            y = self.time_index.get(t)
+            if y is not None:
+                hops.append((y, self.freq_index[f_key[0]], zs))
+        if not hops:
+            return None
+        strip = self.waterfall.strip(min(h[0] for h in hops), max(h[0] for h in hops) + 1)
+        for y, x_start, zs in hops:
+            strip.add(y, x_start, zs)
+        return strip
+
+    # Keep re-rendering as rtl_power appends sweeps, only the new lines get parsed
+    # and only the new rows get coloured, unless the level range moved
+    def follow(self, filename, output, interval, window=None):
+        offset = self.byte_span[1]
+        self.colors = self.rgb2(self.waterfall.result())
+        if window and len(self.times) > window:
+            self.trim_rows(window)
+            self.refresh()
+            self.save(output)
+        while True:
+            time.sleep(interval)
+            end = power_csv.complete_size(filename, offset)
+            if end <= offset:
+                continue
+            print("following %i new bytes" % (end - offset))
+            # --tail moves along with the newest sweep
+            self.slice_times(filename)
+            z_range = (self.min_z, self.max_z)
+            touched = self.append_hops(filename, offset, end)
+            if touched is None:
+                self.calc_summary(filename)
+                self.init_heatmap()
+                self.draw_heatmap(filename)
+                self.colors = self.rgb2(self.waterfall.result())
+                offset = self.byte_span[1]
+            else:
+                self.trim_rows(len(self.times) - bisect.bisect_left(self.times, self.begin_t or ''))
+                offset = end
+            if window:
+                self.trim_rows(window)
+            if touched is not None:
+                self.recolor(touched, z_range)
+            self.refresh()
+            self.save(output)
+
+    # Add freshly appended lines, the times they landed on, None when the hop layout changed
+    def append_hops(self, filename, start, stop):
+        hops = list(self.parse_hops(filename, start, stop))
+        if any(f_key[0] not in self.freq_index for t, f_key, zs in hops):
+            return None
+        new_times = sorted(set(t for t, f_key, zs in hops if t > self.times[-1]))
+        for t in new_times:
+            self.time_index[t] = len(self.times)
+            self.times.append(t)
+        self.waterfall.grow(len(new_times))
+        touched = set()
+        for t, f_key, zs in hops:
+            y = self.time_index.get(t)
+            if y is None:
+                continue
+            touched.add(t)
+            self.waterfall.add(y, self.freq_index[f_key[0]], zs)
+            if not self.db_limit_isset:
+                self.min_z = min(self.min_z, float(zs.min()))
+                self.max_z = max(self.max_z, float(zs.max()))
+        self.timestop = parse_time(self.times[-1])
+        return touched
+
+    # Colour the rows of these times, all of them when the level range changed since z_range
+    def recolor(self, times, z_range):
+        levels = self.waterfall.result()
+        if z_range != (self.min_z, self.max_z):
+            self.colors = self.rgb2(levels)
+            return
+        missing = len(levels) - len(self.colors)
+        if missing > 0:
+            self.colors = numpy.concatenate((self.colors, numpy.zeros((missing,) + self.colors.shape[1:], numpy.uint8)))
+        rows = sorted(self.time_index[t] for t in times if t in self.time_index)
+        if rows:
+            self.colors[rows] = self.rgb2(levels[rows])
+
+    # Rolling output, only the last rows are kept
+    def trim_rows(self, rows):
+        extra = len(self.times) - rows
+        if extra <= 0:
+            return
+        self.times = self.times[extra:]
+        self.time_index = dict((t, y) for y, t in enumerate(self.times))
+        self.timestart = parse_time(self.times[0])
+        self.waterfall.drop(extra)
+        if self.colors is not None:
+            self.colors = self.colors[extra:]
+
+    # Redraw the image around the coloured rows kept by follow()
+    def refresh(self):
+        self.waterwall_height = len(self.times)
+        self.new_image()
+        self.img.paste(Image.fromarray(self.colors), (0, self.tape_height))
+        self.label_heatmap()
+        self.texts = []
+        self.draw_texts()
+        self.draw_legends()
 
     def draw_texts(self):
         duration = self.timestop - self.timestart
@@ -210,8 +755,9 @@ class HeatmapGenerator(object):
 
         # Add Text
         self.add_text('Started: {0}'.format(self.timestart))
-        self.add_text('Pixel: %.2fHz x %is' % (self.step, int(round(pixel_height))))
-        self.add_text('Range: %.2fMHz - %.2fMHz' % (min(self.freqs) / 1e6, (max(self.freqs) + self.step) / 1e6))
+        self.add_text('Pixel: %.2fHz x %is' % (self.step * self.x_scale, int(round(pixel_height))))
+        # self.freqs only holds the first bin of every pixel when downsampled
+        self.add_text('Range: %.2fMHz - %.2fMHz' % (self.freq_left / 1e6, (self.freq_right + self.step) / 1e6))
         self.add_text('Duration: %i:%02i' % (hours, minutes))
 
         # Add text from parameters
@@ -228,64 +774,36 @@ class HeatmapGenerator(object):
 
         # Search legends can be show in heatmap
         legends_can_draw = []
-        # last_freq_find_legende = 0
         for stationsfilename in self.heatmap_parameters['legends']:
-            legends = load_jsonfile(stationsfilename)
-
-            for legend in legends['stations']:
-                if 'name' in legend:
-                    if 'freq_left' in legend:
-                        legend['freq_left'] = hz2Float(legend['freq_left'])
-                        legend['freq_right'] = hz2Float(legend['freq_right'])
-                        legend['bw'] = legend['freq_right'] - legend['freq_left']
-                        legend['freq_center'] = legend['freq_left'] + (legend['bw'] / 2)
-                    else:
-                        legend['freq_center'] = hz2Float(legend['freq_center'])
-                        legend['bw'] = hz2Float(legend['bw'])
-                        legend['freq_left'] = legend['freq_center'] - (legend['bw'] / 2)
-                        legend['freq_right'] = legend['freq_left'] + legend['bw']
-
-                    # Calc Cropped freq (for drawing in heatmap)
-                    legend['cropped_left'] = max(legend['freq_left'], self.freq_left - self.step)
-                    legend['cropped_right'] = min(legend['freq_right'], self.freq_right + self.step)
-                    legend['cropped_bw'] = legend['cropped_right'] - legend['cropped_left']
-                    legend['cropped_center'] = legend['cropped_left'] + (legend['cropped_bw'] / 2)
-
-                    if self.freq_left <= legend['freq_left'] <= self.freq_right or \
-                                            self.freq_left <= legend['freq_right'] <= self.freq_right:
-                        legends_can_draw.append(legend)
-                    else:
-                        if legend['freq_left'] <= self.freq_left and legend['freq_right'] >= self.freq_right:
-                            legends_can_draw.append(legend)
+            for station in load_stations(stationsfilename):
+                if not (station['freq_right'] >= self.freq_left and station['freq_left'] <= self.freq_right):
+                    continue
+                legend = dict(station)
+
+                # Calc Cropped freq (for drawing in heatmap)
+                legend['cropped_left'] = max(legend['freq_left'], self.freq_left - self.step)
+                legend['cropped_right'] = min(legend['freq_right'], self.freq_right + self.step)
+                legend['cropped_bw'] = legend['cropped_right'] - legend['cropped_left']
+                legend['cropped_center'] = legend['cropped_left'] + (legend['cropped_bw'] / 2)
+                legends_can_draw.append(legend)
 
         # Order legends by bandwith
         legends_can_draw = sorted(legends_can_draw, key=lambda x: x['bw'], reverse=True)
 
+        # Every row is kept sorted by freq_left, a legend goes in the first row with a gap for it
+        self.legends_row = []
+        lefts = []
         for legend in legends_can_draw:
-            append_in_same_line = False
-            for lineidx in range(len(self.legends_row)):
-                nbcolumns = len(self.legends_row[lineidx])
-                # Check if can i append the freq
-                if nbcolumns > 0:
-                    if legend['freq_left'] >= self.legends_row[lineidx][nbcolumns - 1]['freq_right'] or \
-                            legend['freq_right'] <= self.legends_row[lineidx][0]['freq_left']:
-                        append_in_same_line = True
-                        break
-
-                if nbcolumns > 1:
-                    for column in range(1, nbcolumns):
-                        if legend['freq_left'] >= self.legends_row[lineidx][column - 1]['freq_right'] and \
-                                        legend['freq_right'] <= self.legends_row[lineidx][column]['freq_left']:
-                            append_in_same_line = True
-                            break
-
-            if append_in_same_line:
-                self.legends_row[lineidx].append(legend)
-                self.legends_row[lineidx] = sorted(self.legends_row[lineidx], key=lambda x: x['freq_left'])
+            for row, row_lefts in zip(self.legends_row, lefts):
+                if legend_fits(row, row_lefts, legend):
+                    i = bisect.bisect_right(row_lefts, legend['freq_left'])
+                    row.insert(i, legend)
+                    row_lefts.insert(i, legend['freq_left'])
+                    break
             else:
                 if len(self.legends_row) + 1 <= self.max_nb_lines_legend:
-                    self.legends_row.append([])
-                    self.legends_row[len(self.legends_row) - 1].append(legend)
+                    self.legends_row.append([legend])
+                    lefts.append([legend['freq_left']])
 
         self.legends_row.reverse()
         self.legends_height = len(self.legends_row) * (self.fontsize + self.legend_line_height + self.legend_line_space)
@@ -293,7 +811,7 @@ class HeatmapGenerator(object):
 
     def draw_legends(self):
         # TODO Refactoring the code for use offset,low,hight parameter
-        print "Draw legends"
+        print("Draw legends")
         freqpixel = self.img_width / (self.freq_right - self.freq_left)
         draw = ImageDraw.Draw(self.img)
 
@@ -308,7 +826,7 @@ class HeatmapGenerator(object):
                 freq_rightpos = ((legend['cropped_left'] + legend['cropped_bw']) - self.freq_left) * freqpixel
 
                 # Calc center text
-                textsizex, textsizey = self.font.getsize(legend['name'])
+                textsizex, textsizey = text_size(self.font, legend['name'])
                 textpos = freq_centerpos - (textsizex / 2)
                 ypos = self.img_height - self.legends_height + (
                     line * (self.fontsize + self.legend_line_height + self.legend_line_space))
@@ -356,7 +874,7 @@ class HeatmapGenerator(object):
     def draw_textfromlist(self):
         ypos = 5
         margin = 2
-        if args.time_tick:
+        if self.time_tick:
             margin = 60
 
         reverse = self.heatmap_parameters and 'reversetextsorder' in self.heatmap_parameters and \
@@ -394,12 +912,24 @@ class HeatmapGenerator(object):
 
     def label_heatmap(self):
         print("labeling")
+        self.draw_tape()
+
+        if self.time_tick:
+            label_last = self.timestart
+            for y, t in enumerate(self.times):
+                label_time = parse_time(t)
+                label_diff = label_time - label_last
+                if label_diff.seconds >= self.time_tick:
+                    self.shadow_text(2, y + self.tape_height, '%s' % t.split(' ')[-1], self.font)
+                    label_last = label_time
+
+    def draw_tape(self):
         draw = ImageDraw.Draw(self.img)
         # gblfont = ImageFont.load_default()
 
 
         # Init tape
-        draw.rectangle([0, 0, self.img_width, self.tape_height], fill='yellow')
+        draw.rectangle([0, 0, self.img.size[0], self.tape_height], fill='yellow')
         # freq_left = min(self.freqs)
         # right_freq = max(self.freqs)
         width = len(self.freqs)
@@ -415,33 +945,28 @@ class HeatmapGenerator(object):
                 label_base = idx
                 break
         label_base = 10 ** label_base
+        lines_used, text_used = set(), set()
 
         for scale, y in [(1, 10), (5, 15), (10, 19), (50, 22), (100, 24), (500, 25)]:
-            hits = self.tape_lines(label_base / scale, y, self.tape_height)
+            hits = self.tape_lines(label_base / scale, y, self.tape_height, lines_used)
             pixels_per_hit = width / hits
             if pixels_per_hit > 50:
-                self.tape_text(label_base / scale, y - self.tape_pt)
+                self.tape_text(label_base / scale, y - self.tape_pt, text_used)
             if pixels_per_hit < 10:
                 break
 
-        if args.time_tick:
-            label_last = self.timestart
-            for y, t in enumerate(self.times):
-                label_time = parse_time(t)
-                label_diff = label_time - label_last
-                if label_diff.seconds >= args.time_tick:
-                    self.shadow_text(2, y + self.tape_height, '%s' % t.split(' ')[-1], self.font)
-                    label_last = label_time
-
-    def tape_lines(self, interval, y1, y2, used=set()):
+    def tape_lines(self, interval, y1, y2, used=None):
         """returns the number of lines"""
+        used = set() if used is None else used
         draw = ImageDraw.Draw(self.img)
-        low_f = (min(self.freqs) // interval) * interval
-        high_f = (1 + max(self.freqs) // interval) * interval
+        # freqs are sorted
+        f_min, f_max = self.freqs[0], self.freqs[-1]
+        low_f = (f_min // interval) * interval
+        high_f = (1 + f_max // interval) * interval
         hits = 0
         blur = lambda p: blend(p, (255, 255, 0), (0, 0, 0))
         for idx in range(int(low_f), int(high_f), int(interval)):
-            if not (min(self.freqs) < idx < max(self.freqs)):
+            if not (f_min < idx < f_max):
                 continue
             hits += 1
             if idx in used:
@@ -456,13 +981,15 @@ class HeatmapGenerator(object):
             used.add(idx)
         return hits
 
-    def tape_text(self, interval, y, used=set()):
-        low_f = (min(self.freqs) // interval) * interval
-        high_f = (1 + max(self.freqs) // interval) * interval
+    def tape_text(self, interval, y, used=None):
+        used = set() if used is None else used
+        f_min, f_max = self.freqs[0], self.freqs[-1]
+        low_f = (f_min // interval) * interval
+        high_f = (1 + f_max // interval) * interval
         for idx in range(int(low_f), int(high_f), int(interval)):
             if idx in used:
                 continue
-            if not (min(self.freqs) < idx < max(self.freqs)):
+            if not (f_min < idx < f_max):
                 continue
             x = closest_index(idx, self.freqs)
             if interval >= 1e6:
@@ -486,11 +1013,69 @@ class HeatmapGenerator(object):
 # Functions
 # #######################################
 
-def frange(start, stop, step):
-    idx = 0
-    while idx * step + start <= stop:
-        yield idx * step + start
-        idx += 1
+# Process pool workers, they are forked with a copy of the generator
+pool_generator = None
+
+
+def group_percentile(keys, values, q):
+    """percentile of the values of every distinct key, interpolated like numpy"""
+    order = numpy.lexsort((values, keys))
+    keys = keys[order]
+    values = values[order]
+    starts = numpy.flatnonzero(numpy.diff(keys, prepend=keys[0] - 1))
+    counts = numpy.diff(numpy.append(starts, len(keys)))
+    pos = starts + (counts - 1) * (q / 100.0)
+    lo = numpy.floor(pos).astype(int)
+    hi = numpy.ceil(pos).astype(int)
+    return keys[starts], values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+# Parsed station lists by path, reloaded when the file changes
+stations_cache = {}
+
+
+def load_stations(filename):
+    """named stations of a legends JSON file, with freq_left, freq_right, freq_center and bw in Hz"""
+    mtime = os.path.getmtime(filename)
+    cached = stations_cache.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    stations = []
+    for legend in load_jsonfile(filename)['stations']:
+        if 'name' not in legend:
+            continue
+        legend = dict(legend)
+        if 'freq_left' in legend:
+            legend['freq_left'] = hz2Float(legend['freq_left'])
+            legend['freq_right'] = hz2Float(legend['freq_right'])
+            legend['bw'] = legend['freq_right'] - legend['freq_left']
+            legend['freq_center'] = legend['freq_left'] + (legend['bw'] / 2)
+        else:
+            legend['freq_center'] = hz2Float(legend['freq_center'])
+            legend['bw'] = hz2Float(legend['bw'])
+            legend['freq_left'] = legend['freq_center'] - (legend['bw'] / 2)
+            legend['freq_right'] = legend['freq_left'] + legend['bw']
+        stations.append(legend)
+    stations_cache[filename] = (mtime, stations)
+    return stations
+
+
+def legend_fits(row, lefts, legend):
+    """True when the legend fits between two neighbours of a row sorted by freq_left"""
+    left, right = legend['freq_left'], legend['freq_right']
+    # only the gaps around the legends starting at the same freq can hold it
+    for i in range(bisect.bisect_left(lefts, left), bisect.bisect_right(lefts, left) + 1):
+        if (i == 0 or row[i - 1]['freq_right'] <= left) and (i == len(row) or right <= lefts[i]):
+            return True
+    return False
+
+
+def summary_band(band):
+    return pool_generator.summarize(*band)
+
+
+def draw_band(band):
+    return pool_generator.draw_strip(*band)
 
 
 # def min_filter(row):
@@ -534,24 +1119,6 @@ def sec2Float(stringvalue):
     return unity2Float(stringvalue, secUnities)
 
 
-def floatify(zs):
-    # nix errors with -inf, windows errors with -1.#J
-    zs2 = []
-    previous = 0  # awkward for single-column rows
-    for z in zs:
-        try:
-            z = float(z)
-        except ValueError:
-            z = previous
-        if math.isinf(z):
-            z = previous
-        if math.isnan(z):
-            z = previous
-        zs2.append(z)
-        previous = z
-    return zs2
-
-
 def freq_parse(s):
     suffix = 1
     if s.lower().endswith('k'):
@@ -565,37 +1132,18 @@ def freq_parse(s):
     return float(s) * suffix
 
 
-def duration_parse(s):
-    suffix = 1
-    if s.lower().endswith('s'):
-        suffix = 1
-    if s.lower().endswith('m'):
-        suffix = 60
-    if s.lower().endswith('h'):
-        suffix = 60 * 60
-    if suffix != 1 or s.lower().endswith('s'):
-        s = s[:-1]
-    return float(s) * suffix
-
-
-def gzip_wrap(path):
-    """hides silly CRC errors"""
-    iterator = gzip.open(path, 'rb')
-    running = True
-    while running:
+def parse_aggregate(s):
+    """'mean', 'max' or 'p90' to the Downsampler how and percentile"""
+    if s in ('mean', 'max'):
+        return s, 50
+    if s.startswith('p'):
         try:
-            yield next(iterator)
-        except IOError:
-            running = False
-
-
-def load_jsonfile(filename):
-    exists = os.path.isfile(filename)
-    if exists:
-        configlines = open(filename).read()
-        return json.loads(configlines)
-
-    return None
+            q = float(s[1:])
+        except ValueError:
+            q = -1
+        if 0 <= q <= 100:
+            return 'percentile', q
+    raise ValueError('--aggregate takes mean, max or pNN with NN from 0 to 100, not %r' % s)
 
 
 def parse_time(t):
@@ -639,14 +1187,37 @@ def closest_index(n, m_list, interpolate=False):
     return idx, idx
 
 
+# CSV summaries by summary_key, for --batch and render()
+summary_cache = collections.OrderedDict()
+summary_cache_size = 8
+
+
+@functools.lru_cache(maxsize=32)
+def load_font(pt):
+    """Vera.ttf from the current directory, else the one next to this script"""
+    try:
+        return ImageFont.truetype("Vera.ttf", pt)
+    except IOError:
+        return ImageFont.truetype(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Vera.ttf"), pt)
+
+
+def text_size(font, text):
+    """getsize went away in Pillow 10"""
+    if hasattr(font, 'getsize'):
+        return font.getsize(text)
+    return tuple(font.getbbox(text)[2:])
+
+
+# Labels repeat across renders, callers paste the sprite and never draw on it
+@functools.lru_cache(maxsize=1024)
 def word_aa(label, pt, fg_color, bg_color):
-    f = ImageFont.truetype("Vera.ttf", pt * 3)
-    s = f.getsize(label)
+    f = load_font(pt * 3)
+    s = text_size(f, label)
     s = (s[0], pt * 3 + 3)  # getsize lies, manually compute
     w_img = Image.new("RGB", s, bg_color)
     w_draw = ImageDraw.Draw(w_img)
     w_draw.text((0, 0), label, font=f, fill=fg_color)
-    return w_img.resize((s[0] // 3, s[1] // 3), Image.ANTIALIAS)
+    return w_img.resize((s[0] // 3, s[1] // 3), Image.LANCZOS)
 
 
 def blend(percent, c1, c2):
@@ -662,80 +1233,223 @@ def blend(percent, c1, c2):
 # Main
 ########################################
 
-parser = argparse.ArgumentParser(description='Convert rtl_power CSV files into graphics.')
-parser.add_argument('input_path', metavar='INPUT', type=str,
-                    help='Input CSV file. (may be a .csv.gz)')
-parser.add_argument('output_path', metavar='OUTPUT', type=str,
-                    help='Output image. (various extensions supported)')
-parser.add_argument('--offset', dest='offset_freq', default=None,
-                    help='Shift the entire frequency range, for up/down converters.')
-parser.add_argument('--ytick', dest='time_tick', default=None,
-                    help='Place ticks along the Y axis every N seconds.')
-parser.add_argument('--db', dest='db_limit', nargs=2, default=None,
-                    help='Maximum and minimum db values.')
-slicegroup = parser.add_argument_group('Slicing',
-                                       'Efficiently render a portion of the data. (optional)')
-slicegroup.add_argument('--low', dest='low_freq', default=None,
-                        help='Minimum frequency for a subrange.')
-slicegroup.add_argument('--high', dest='high_freq', default=None,
-                        help='Maximum frequency for a subrange.')
-slicegroup.add_argument('--parameters', dest='heatmap_parameters', default=None, action='append',
-                        help='heatmap parameters JSON file')
-"""
-slicegroup.add_argument('--begin', dest='begin_time', default=None,
-    help='Timestamp to start at.')
-slicegroup.add_argument('--end', dest='end_time', default=None,
-    help='Timestamp to stop at.')
-slicegroup.add_argument('--head', dest='head_time', default=None,
-    help='Duration to use, starting at the beginning.')
-slicegroup.add_argument('--tail', dest='tail_time', default=None,
-    help='Duration to use, stopping at the end.')
-"""
-
-# hack, http://stackoverflow.com/questions/9025204/
-for i, arg in enumerate(sys.argv):
-    if (arg[0] == '-') and arg[1].isdigit():
-        sys.argv[i] = ' ' + arg
-args = parser.parse_args()
-
-
-# Init heatmap generator
-heatmap_generator = HeatmapGenerator()
-
-# Check frequencies command line parameters
-if args.low_freq is not None:
-    heatmap_generator.low_freq = freq_parse(args.low_freq)
-if args.high_freq is not None:
-    heatmap_generator.high_freq = freq_parse(args.high_freq)
-if args.offset_freq is not None:
-    heatmap_generator.offset_freq = freq_parse(args.offset_freq)
-
-if args.time_tick is not None:
-    heatmap_generator.time_tick = duration_parse(args.time_tick)
-
-# Modify dB limit
-if args.db_limit:
-    heatmap_generator.set_db_limit(min(map(float, args.db_limit)), max(map(float, args.db_limit)))
-
-# Load heatmap parameters JSON files
-hparameters = None
-if args.heatmap_parameters is not None:
-    global_heatmap_params = {}
-    for filename in args.heatmap_parameters:
-        hparameters = load_jsonfile(filename)
-        global_heatmap_params.update(hparameters)
-    heatmap_generator.set_heatmap_parameters(global_heatmap_params)
-
-# Compute CSV datas
-heatmap_generator.calc_summary(args.input_path)
-heatmap_generator.calc_legends_height()
-heatmap_generator.init_heatmap()
-
-# Draw the heatmap
-heatmap_generator.draw_heatmap(args.input_path)
-heatmap_generator.label_heatmap()
-heatmap_generator.draw_texts()
-heatmap_generator.draw_legends()
-
-# Save the result
-heatmap_generator.save(args.output_path)
+def build_parser():
+    parser = argparse.ArgumentParser(description='Convert rtl_power CSV files into graphics.')
+    parser.add_argument('input_path', metavar='INPUT', type=str, nargs='?',
+                        help='Input CSV file. (may be a .csv.gz or a sweep store)')
+    parser.add_argument('output_path', metavar='OUTPUT', type=str, nargs='?',
+                        help='Output image. (various extensions supported)')
+    parser.add_argument('--batch', dest='batch', default=None,
+                        help='Render every job of a manifest in this process, one "INPUT OUTPUT [options]" per line. (- for stdin)')
+    parser.add_argument('--offset', dest='offset_freq', default=None,
+                        help='Shift the entire frequency range, for up/down converters.')
+    parser.add_argument('--ytick', dest='time_tick', default=None,
+                        help='Place ticks along the Y axis every N seconds.')
+    parser.add_argument('--db', dest='db_limit', nargs=2, default=None,
+                        help='Maximum and minimum db values.')
+    parser.add_argument('--single-pass', dest='single_pass', action='store_true', default=False,
+                        help='Parse the CSV once and render from a compact spool. (faster on large files)')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help='Parse and draw bands of the CSV with N processes.')
+    parser.add_argument('--follow', dest='follow', default=None,
+                        help='Keep rendering a growing file every N seconds, parsing only the new sweeps.')
+    parser.add_argument('--window', dest='window', type=int, default=None,
+                        help='With --follow, only keep the last N sweeps.')
+    parser.add_argument('--tiles', dest='tile_format', default=None, choices=['png', 'webp'],
+                        help='Write a z/x/y tile pyramid into the OUTPUT folder instead of one image.')
+    parser.add_argument('--max-width', dest='max_width', type=int, default=None,
+                        help='Aggregate frequency bins down to N pixels wide.')
+    parser.add_argument('--max-height', dest='max_height', type=int, default=None,
+                        help='Aggregate sweeps down to N pixels high.')
+    parser.add_argument('--aggregate', dest='aggregate', default='mean',
+                        help='How bins and sweeps combine into a pixel: mean, max or pNN (percentile).')
+    parser.add_argument('--stats', '--run-stats', dest='run_stats', default=None, choices=['json', 'text'],
+                        help='Timings, lines read and peak memory per phase on stderr at the end, progress every few seconds.')
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help='Profile the run into this file, .html or .txt use pyinstrument, else a cProfile dump.')
+    slicegroup = parser.add_argument_group('Slicing',
+                                           'Efficiently render a portion of the data. (optional)')
+    slicegroup.add_argument('--low', dest='low_freq', default=None,
+                            help='Minimum frequency for a subrange.')
+    slicegroup.add_argument('--high', dest='high_freq', default=None,
+                            help='Maximum frequency for a subrange.')
+    slicegroup.add_argument('--parameters', dest='heatmap_parameters', default=None, action='append',
+                            help='heatmap parameters JSON file')
+    slicegroup.add_argument('--begin', dest='begin_time', default=None,
+                            help='Timestamp to start at. (YYYY-MM-DD HH:MM:SS)')
+    slicegroup.add_argument('--end', dest='end_time', default=None,
+                            help='Timestamp to stop at. (YYYY-MM-DD HH:MM:SS)')
+    slicegroup.add_argument('--head', dest='head_time', default=None,
+                            help='Duration to use, starting at the beginning.')
+    slicegroup.add_argument('--tail', dest='tail_time', default=None,
+                            help='Duration to use, stopping at the end.')
+    return parser
+
+
+def parse_args(argv):
+    parser = build_parser()
+    # hack, http://stackoverflow.com/questions/9025204/
+    argv = list(argv)
+    for i, arg in enumerate(argv):
+        if (arg[0] == '-') and arg[1:2].isdigit():
+            argv[i] = ' ' + arg
+    args = parser.parse_args(argv)
+    if args.batch is None and (args.input_path is None or args.output_path is None):
+        parser.error('INPUT and OUTPUT are required without --batch')
+    try:
+        check_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+# The checks argparse can not do, shared by parse_args and render
+def check_args(args):
+    for option, value in (('--begin', args.begin_time), ('--end', args.end_time)):
+        try:
+            if value is not None:
+                power_csv.time_to_epoch(value)
+        except ValueError:
+            raise ValueError('%s takes a YYYY-MM-DD HH:MM:SS timestamp, not %r' % (option, value))
+    for option, value in (('--head', args.head_time), ('--tail', args.tail_time),
+                          ('--ytick', args.time_tick), ('--follow', args.follow)):
+        try:
+            if value is not None:
+                duration_parse(str(value))
+        except ValueError:
+            raise ValueError('%s takes a duration like 30s, 10m or 2h, not %r' % (option, value))
+    parse_aggregate(args.aggregate)
+    if args.follow is not None and (args.max_width or args.max_height):
+        raise ValueError('--follow draws at full resolution, use --window to bound it')
+    if args.follow is not None and (args.input_path.endswith('.gz') or sweep_store.is_store(args.input_path)):
+        raise ValueError('--follow needs a plain CSV')
+    if args.window is not None and args.follow is None:
+        raise ValueError('--window only applies to --follow')
+
+
+# Set up a generator from parsed command line options
+def configure(heatmap_generator, args):
+    heatmap_generator.single_pass = args.single_pass
+    heatmap_generator.jobs = args.jobs
+    heatmap_generator.live = args.follow is not None
+    heatmap_generator.tile_format = args.tile_format
+    heatmap_generator.max_width = args.max_width
+    heatmap_generator.max_height = args.max_height
+    heatmap_generator.downsample, heatmap_generator.percentile = parse_aggregate(args.aggregate)
+
+    # Check frequencies command line parameters
+    if args.low_freq is not None:
+        heatmap_generator.low_freq = freq_parse(str(args.low_freq))
+    if args.high_freq is not None:
+        heatmap_generator.high_freq = freq_parse(str(args.high_freq))
+    if args.offset_freq is not None:
+        heatmap_generator.offset_freq = freq_parse(str(args.offset_freq))
+
+    if args.time_tick is not None:
+        heatmap_generator.time_tick = duration_parse(str(args.time_tick))
+
+    # Check time slicing command line parameters
+    heatmap_generator.begin_time = args.begin_time
+    heatmap_generator.end_time = args.end_time
+    if args.head_time is not None:
+        heatmap_generator.head_time = duration_parse(str(args.head_time))
+    if args.tail_time is not None:
+        heatmap_generator.tail_time = duration_parse(str(args.tail_time))
+
+    # Modify dB limit
+    if args.db_limit:
+        heatmap_generator.set_db_limit(min(map(float, args.db_limit)), max(map(float, args.db_limit)))
+
+    # Load heatmap parameters JSON files
+    if args.heatmap_parameters is not None:
+        global_heatmap_params = {}
+        for filename in args.heatmap_parameters:
+            hparameters = load_jsonfile(filename)
+            global_heatmap_params.update(hparameters)
+        heatmap_generator.set_heatmap_parameters(global_heatmap_params)
+    return heatmap_generator
+
+
+# One full render, returns the generator (for --follow)
+def run(args):
+    heatmap_generator = configure(HeatmapGenerator(), args)
+
+    # Compute CSV datas
+    with instrument.phase('loading'):
+        heatmap_generator.calc_summary(args.input_path)
+    with instrument.phase('legends'):
+        heatmap_generator.calc_legends_height()
+        heatmap_generator.init_heatmap()
+
+    # Draw the heatmap
+    with instrument.phase('drawing', heatmap_generator.span_bytes(args.input_path)):
+        heatmap_generator.draw_heatmap(args.input_path)
+    with instrument.phase('labeling'):
+        heatmap_generator.label_heatmap()
+        heatmap_generator.draw_texts()
+        heatmap_generator.draw_legends()
+
+    # Save the result
+    with instrument.phase('saving'):
+        heatmap_generator.save(args.output_path)
+    return heatmap_generator
+
+
+def render(input_path, output_path, **options):
+    """library entry point, options are the command line ones by dest name,
+    like render('in.csv', 'out.png', low_freq='88M', db_limit=(-60, 0), jobs=4)"""
+    args = build_parser().parse_args([input_path, output_path])
+    for key, value in options.items():
+        if not hasattr(args, key):
+            raise TypeError('unknown option %s' % key)
+        setattr(args, key, value)
+    check_args(args)
+    return run(args)
+
+
+def run_batch(manifest):
+    """renders every line of a manifest, a failed job does not stop the others
+    fonts, label sprites, station lists and CSV summaries stay cached between jobs"""
+    if manifest == '-':
+        return run_jobs(sys.stdin)
+    with open(manifest) as fd:
+        return run_jobs(fd)
+
+
+def run_jobs(fd):
+    failed = 0
+    for number, line in enumerate(fd, 1):
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        print("batch job %i: %s" % (number, ' '.join(argv[:2])))
+        try:
+            args = parse_args(argv)
+            if args.batch is not None or args.follow is not None:
+                raise ValueError('--batch and --follow do not nest in a manifest')
+            run(args)
+        except SystemExit:
+            print("batch job %i failed: bad arguments" % number)
+            failed += 1
+        except Exception as e:
+            print("batch job %i failed: %s" % (number, e))
+            failed += 1
+    return failed
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.run_stats:
+        instrument.enable(args.run_stats)
+    if args.profile:
+        instrument.start_profile(args.profile)
+    if args.batch is not None:
+        sys.exit(1 if run_batch(args.batch) else 0)
+    try:
+        heatmap_generator = run(args)
+    except (IOError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    if args.follow is not None:
+        heatmap_generator.follow(args.input_path, args.output_path, duration_parse(args.follow), args.window)
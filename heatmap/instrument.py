@@ -0,0 +1,234 @@
+"""
+phase timings for heatmap.py, raw_iq.py and flatten.py
+wall and cpu time, lines and bytes read, peak memory, progress with an ETA on stderr
+does nothing until enable(), the counters are shared with forked pool workers
+"""
+
+import os, sys, json, time, atexit, multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None  # windows, the memory figures stay 0
+
+# seconds between two progress lines
+progress_seconds = 10
+
+enabled = False
+phases = []
+active = None
+counters = None  # lines, bytes, shared with the workers forked after enable()
+owner = None
+
+
+def peak_rss():
+    """MB, the VmHWM high water mark on linux, else ru_maxrss"""
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def reset_peak_rss():
+    """linux only, elsewhere the peak is for the whole run so far"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+    except IOError:
+        pass
+
+
+def fork_context():
+    """the fork start method the pools rely on, None where it does not exist (windows)
+    callers then take their serial path"""
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+
+def children_time():
+    """cpu seconds of the reaped pool workers"""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def children_peak_rss():
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / (1024.0 * 1024) if sys.platform == 'darwin' else peak / 1024.0
+
+
+class Phase(object):
+    """one timed step, total is the byte count the ETA is computed against"""
+
+    def __init__(self, name, total=None):
+        self.name = name
+        self.total = total
+        self.wall = self.cpu = 0.0
+        self.lines = self.bytes = 0
+        self.peak = self.children_peak = 0.0
+        self.last_report = 0
+
+    def __enter__(self):
+        global active
+        active = self
+        reset_peak_rss()
+        self.lines0, self.bytes0 = counters[:]
+        self.cpu0 = time.process_time() + children_time()
+        self.wall0 = self.last_report = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global active
+        self.update()
+        self.wall = time.perf_counter() - self.wall0
+        self.cpu = time.process_time() + children_time() - self.cpu0
+        self.peak = peak_rss()
+        self.children_peak = children_peak_rss()
+        active = None
+        phases.append(self)
+
+    def update(self):
+        lines, nbytes = counters[:]
+        self.lines = int(lines - self.lines0)
+        self.bytes = int(nbytes - self.bytes0)
+
+    def progress(self):
+        self.update()
+        elapsed = time.perf_counter() - self.wall0
+        text = '%s: %i lines, %.1f MB, %.0f lines/s, %.1f MB/s' % (
+            self.name, self.lines, self.bytes / 1e6, self.lines / elapsed, self.bytes / 1e6 / elapsed)
+        if self.total and self.bytes:
+            eta = elapsed * max(0, self.total - self.bytes) / self.bytes
+            text += ', %.0f%%, eta %s' % (min(100.0, 100.0 * self.bytes / self.total),
+                                         time.strftime('%H:%M:%S', time.gmtime(eta)))
+        sys.stderr.write(text + '\n')
+
+    def record(self):
+        return {'phase': self.name, 'wall': self.wall, 'cpu': self.cpu,
+                'lines': self.lines, 'bytes': self.bytes,
+                'lines_per_s': self.lines / self.wall if self.wall else 0,
+                'mb_per_s': self.bytes / 1e6 / self.wall if self.wall else 0,
+                'peak_rss_mb': round(self.peak, 1), 'children_peak_rss_mb': round(self.children_peak, 1)}
+
+
+class Idle(object):
+    """stands in for a Phase while disabled"""
+    total = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def enable(fmt='json'):
+    """the report goes to stderr when the script exits, sys.exit() included"""
+    global enabled, counters, owner
+    if enabled:
+        return
+    enabled = True
+    counters = (fork_context() or multiprocessing).Array('d', 2)
+    owner = os.getpid()
+    atexit.register(write, fmt)
+
+
+def phase(name, total=None):
+    """with phase('drawing'): ..."""
+    if not enabled:
+        return Idle()
+    return Phase(name, total)
+
+
+def expect(total):
+    """the byte count of the running phase, once it is known"""
+    if active is not None:
+        active.total = total
+
+
+def count(lines, nbytes):
+    """called by the readers for every block, from any process"""
+    if not enabled:
+        return
+    with counters.get_lock():
+        counters[0] += lines
+        counters[1] += nbytes
+    tick()
+
+
+def count_lines(block):
+    """a block of text lines"""
+    if enabled:
+        count(len(block), sum(map(len, block)))
+
+
+def tick():
+    """a progress line every progress_seconds, only from the main process"""
+    if active is None or os.getpid() != owner:
+        return
+    now = time.perf_counter()
+    if now - active.last_report >= progress_seconds:
+        active.last_report = now
+        active.progress()
+
+
+def report():
+    records = [p.record() for p in phases]
+    total = {'wall': sum(r['wall'] for r in records), 'cpu': sum(r['cpu'] for r in records),
+             'peak_rss_mb': max([r['peak_rss_mb'] for r in records] or [0]),
+             'children_peak_rss_mb': max([r['children_peak_rss_mb'] for r in records] or [0])}
+    return {'phases': records, 'total': total}
+
+
+def write(fmt='json', out=None):
+    out = out or sys.stderr
+    data = report()
+    if fmt == 'json':
+        out.write(json.dumps(data, indent=4) + '\n')
+        return
+    for r in data['phases']:
+        out.write('%-16s %8.3fs wall %8.3fs cpu %10i lines %10.0f lines/s %8.1f MB/s %8.1f MB peak\n' % (
+            r['phase'], r['wall'], r['cpu'], r['lines'], r['lines_per_s'], r['mb_per_s'], r['peak_rss_mb']))
+    total = data['total']
+    out.write('%-16s %8.3fs wall %8.3fs cpu %50.1f MB peak\n' % ('total', total['wall'], total['cpu'], total['peak_rss_mb']))
+
+
+def start_profile(path):
+    """profiles the rest of the run, dumped at exit
+    .html or .txt goes through pyinstrument if it is installed,
+    anything else is a cProfile dump for pstats or snakeviz"""
+    if path.endswith(('.html', '.txt')):
+        try:
+            import pyinstrument
+        except ImportError:
+            pyinstrument = None
+        if pyinstrument is not None:
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+
+            def dump():
+                profiler.stop()
+                with open(path, 'w') as fd:
+                    fd.write(profiler.output_html() if path.endswith('.html') else profiler.output_text())
+            atexit.register(dump)
+            return
+        sys.stderr.write('pyinstrument is not installed, writing a cProfile dump to %s\n' % path)
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def dump():
+        profiler.disable()
+        profiler.dump_stats(path)
+    atexit.register(dump)
@@ -0,0 +1,474 @@
+"""
+bulk parser for rtl_power csv files
+turns chunks of lines into numpy arrays instead of going value by value
+"""
+
+import os, re, sys, json, gzip, struct, zlib, bisect, calendar, time, warnings
+from collections import namedtuple
+import numpy
+import instrument
+
+# One parsed block of hop lines.  The levels of line i are
+# levels[offsets[i]:offsets[i+1]], already floatified.
+Chunk = namedtuple('Chunk', 'times low high step samples levels offsets')
+
+chunk_lines = 4096
+# -1.#J, -1.#IND, 1.#INF and the like
+windows_nan = re.compile(r'[^,]*#[^,]*')
+index_stride = 2 ** 16
+
+# Indexed gzip: a multi-member file, every member holds whole lines and
+# its header extra field says how long the member is and which sweeps
+# it covers.  Plain gzip readers see one ordinary stream.
+member_extra = struct.Struct('<2sHIIqq')  # b'RP', length, member bytes, text bytes, first and last epoch
+member_bytes = 2 ** 22
+
+
+def time_to_epoch(t):
+    return calendar.timegm(time.strptime(t, '%Y-%m-%d %H:%M:%S'))
+
+
+def epoch_to_time(e):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(e))
+
+
+def frange(start, stop, step):
+    """the bin frequencies of a hop, one past high like rtl_power writes them"""
+    idx = 0
+    while idx * step + start <= stop:
+        yield idx * step + start
+        idx += 1
+
+
+def duration_parse(s):
+    suffix = 1
+    if s.lower().endswith('s'):
+        suffix = 1
+    if s.lower().endswith('m'):
+        suffix = 60
+    if s.lower().endswith('h'):
+        suffix = 60 * 60
+    if suffix != 1 or s.lower().endswith('s'):
+        s = s[:-1]
+    return float(s) * suffix
+
+
+def load_jsonfile(filename):
+    exists = os.path.isfile(filename)
+    if exists:
+        configlines = open(filename).read()
+        return json.loads(configlines)
+
+    return None
+
+
+def line_time(line):
+    """'date, time' of a raw line, without parsing the rest"""
+    fields = line.split(',', 2)
+    return fields[0].strip() + ' ' + fields[1].strip()
+
+
+# keys of the warnings already given, a file is read more than once per render
+warned = set()
+
+
+def warn(message, key=None):
+    """key makes it a once per process warning"""
+    if key is not None:
+        if key in warned:
+            return
+        warned.add(key)
+    sys.stderr.write('warning: %s\n' % message)
+
+
+def gzip_wrap(path):
+    """hides silly CRC errors, but says where the file stopped"""
+    iterator = gzip.open(path, 'rt')
+    count = 0
+    while True:
+        try:
+            line = next(iterator)
+        except StopIteration:
+            return
+        except (IOError, EOFError) as e:
+            warn('%s is damaged after %i lines, the rest is skipped (%s)' % (path, count, e), ('damaged', path))
+            return
+        count += 1
+        yield line
+
+
+def gzip_member(text, first=0, last=0, level=6):
+    """one self-describing gzip member, text is bytes"""
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = deflate.compress(text) + deflate.flush()
+    size = 12 + member_extra.size + len(body) + 8
+    extra = member_extra.pack(b'RP', member_extra.size - 4, size, len(text), first, last)
+    head = struct.pack('<BBBBIBBH', 0x1f, 0x8b, 8, 4, 0, 0, 255, len(extra))
+    return head + extra + body + struct.pack('<II', zlib.crc32(text) & 0xffffffff, len(text) & 0xffffffff)
+
+
+def write_gzip(lines, path, size=None):
+    """lines to an indexed gzip, members of about size bytes of text"""
+    size = size or member_bytes
+    block, first, last = [], 0, 0
+    filled = 0
+    with open(path, 'wb') as fd:
+        for line in lines:
+            if len(line.split(',', 6)) >= 7:
+                last = time_to_epoch(line_time(line))
+                first = first or last
+            block.append(line)
+            filled += len(line)
+            if filled >= size:
+                fd.write(gzip_member(''.join(block).encode('latin-1'), first, last))
+                block, first, filled = [], 0, 0
+        if block:
+            fd.write(gzip_member(''.join(block).encode('latin-1'), first, last))
+
+
+members_cache = {}
+
+
+def gzip_members(path):
+    """[(offset, size, first epoch, last epoch)] of an indexed gzip, None for a plain one
+    only the member headers are read"""
+    stamp = (os.path.getsize(path), os.path.getmtime(path))
+    cached = members_cache.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    members = []
+    offset = 0
+    with open(path, 'rb') as fd:
+        while offset < stamp[0]:
+            fd.seek(offset)
+            head = fd.read(12 + member_extra.size)
+            if len(head) < 12 + member_extra.size or head[:2] != b'\x1f\x8b' or not head[3] & 4:
+                members = None
+                break
+            tag, length, size, text, first, last = member_extra.unpack_from(head, 12)
+            if tag != b'RP':
+                members = None
+                break
+            members.append((offset, size, first, last))
+            offset += size
+    members = members or None
+    members_cache[path] = (stamp, members)
+    return members
+
+
+def read_members(path, members, start=0, stop=None):
+    """lines of the members starting in [start, stop)"""
+    end = os.path.getsize(path)
+    with open(path, 'rb') as fd:
+        for offset, size, first, last in members:
+            if offset < start or (stop is not None and offset >= stop):
+                continue
+            fd.seek(offset)
+            blob = fd.read(size)
+            try:
+                text = zlib.decompress(blob, 31)
+            except zlib.error as e:
+                warn('%s is damaged at byte %i, keeping the complete lines (%s)' % (path, offset, e), ('damaged', path))
+                text = zlib.decompressobj(31).decompress(blob)
+                text = text[:text.rfind(b'\n') + 1]
+            for line in text.decode('latin-1').splitlines(True):
+                yield line
+            if offset + size > end:
+                return
+
+
+def member_bounds(path, member):
+    """first and last epoch of the complete lines a member decodes to, 0 when there are none"""
+    first, last = 0, 0
+    for line in read_members(path, [member]):
+        if len(line.split(',', 6)) >= 7:
+            last = time_to_epoch(line_time(line))
+            first = first or last
+    return first, last
+
+
+def splittable(path):
+    return not path.endswith('.gz') or gzip_members(path) is not None
+
+
+def byte_ranges(path, parts, start=0, stop=None):
+    """cuts [start, stop) in about equal ranges, on line boundaries
+    indexed gzip is cut on member boundaries"""
+    if stop is None:
+        stop = os.path.getsize(path)
+    size = stop - start
+    if path.endswith('.gz'):
+        offsets = [m[0] for m in gzip_members(path) if start <= m[0] < stop]
+        if not offsets:
+            return []
+        cuts = [offsets[min(len(offsets) - 1, bisect.bisect_left(offsets, start + size * i // parts))]
+                for i in range(parts)] + [stop]
+        return [(a, b) for a, b in zip(cuts, cuts[1:]) if a < b]
+    cuts = [start]
+    with open(path, 'rb') as fd:
+        for i in range(1, parts):
+            fd.seek(max(start + size * i // parts - 1, cuts[-1]))
+            fd.readline()
+            cuts.append(min(fd.tell(), stop))
+    cuts.append(stop)
+    return [(a, b) for a, b in zip(cuts, cuts[1:]) if a < b]
+
+
+def complete_size(path, start=0):
+    """end of the last complete line, rtl_power may be halfway through one"""
+    pos = os.path.getsize(path)
+    with open(path, 'rb') as fd:
+        while pos > start:
+            step = min(4096, pos - start)
+            fd.seek(pos - step)
+            i = fd.read(step).rfind(b'\n')
+            if i >= 0:
+                return pos - step + i + 1
+            pos -= step
+    return start
+
+
+def read_range(path, start, stop):
+    """lines starting in [start, stop)"""
+    with open(path, 'rb') as fd:
+        fd.seek(start)
+        pos = start
+        for line in fd:
+            if stop is not None and pos >= stop:
+                break
+            pos += len(line)
+            yield line.decode('latin-1')
+
+
+def read_lines(path, start=0, stop=None):
+    if path.endswith('.gz'):
+        members = gzip_members(path)
+        if members is not None:
+            return read_members(path, members, start, stop)
+        return gzip_wrap(path)
+    if start or stop is not None:
+        return read_range(path, start, stop)
+    return open(path)
+
+
+def safe_float(s):
+    try:
+        return float(s)
+    except ValueError:
+        return numpy.nan
+
+
+def fill_gaps(levels, offsets):
+    """nix errors with -inf, windows errors with -1.#J
+    every non finite level repeats the previous one, 0 at the start of a line"""
+    bad = ~numpy.isfinite(levels)
+    if not bad.any():
+        return levels
+    last = numpy.where(bad, -1, numpy.arange(len(levels)))
+    numpy.maximum.accumulate(last, out=last)
+    starts = numpy.repeat(offsets[:-1], numpy.diff(offsets))
+    return numpy.where(last >= starts, levels[last], 0.0)
+
+
+def floatify(zs):
+    """single line version of fill_gaps, takes strings"""
+    levels = numpy.array([safe_float(z) for z in zs], numpy.float64)
+    return fill_gaps(levels, numpy.array([0, len(levels)]))
+
+
+def parse_levels(text, count):
+    """count comma separated levels in one go, fromstring parses in C
+    windows writes -1.#J, those and anything else unreadable become nan"""
+    if '#' in text:
+        text = text.replace('-1.#J', 'nan')
+    if '#' in text:
+        text = windows_nan.sub('nan', text)
+    try:
+        with warnings.catch_warnings():
+            # older numpy only warns about unreadable data and returns what it got
+            warnings.simplefilter('error', DeprecationWarning)
+            levels = numpy.fromstring(text, numpy.float64, sep=',') if count else numpy.zeros(0)
+        if len(levels) == count:
+            return levels
+    except (ValueError, DeprecationWarning):
+        pass
+    return numpy.array([safe_float(s) for s in text.split(',')], numpy.float64)
+
+
+def parse_lines(lines):
+    times = []
+    heads = []
+    texts = []
+    widths = []
+    for line in lines:
+        fields = line.split(',', 6)
+        rest = fields.pop().rstrip(', \t\r\n') if len(fields) == 7 else ''
+        if len(fields) < 6 or not fields[5].strip():
+            continue
+        times.append(fields[0].strip() + ' ' + fields[1].strip())
+        heads.append(fields[2:6])
+        if rest:
+            texts.append(rest)
+            widths.append(rest.count(',') + 1)
+        else:
+            widths.append(0)
+
+    heads = numpy.array(heads, numpy.float64).reshape(-1, 4)
+    offsets = numpy.zeros(len(widths) + 1, numpy.int64)
+    numpy.cumsum(widths, out=offsets[1:])
+    levels = parse_levels(','.join(texts), int(offsets[-1]))
+    return Chunk(times,
+                 heads[:, 0].astype(numpy.int64),
+                 heads[:, 1].astype(numpy.int64),
+                 heads[:, 2],
+                 heads[:, 3].astype(numpy.int64),
+                 fill_gaps(levels, offsets),
+                 offsets)
+
+
+def chunk_slice(chunk, start, stop):
+    """lines [start, stop) of a chunk"""
+    a, b = chunk.offsets[start], chunk.offsets[stop]
+    return Chunk(chunk.times[start:stop], chunk.low[start:stop], chunk.high[start:stop],
+                 chunk.step[start:stop], chunk.samples[start:stop], chunk.levels[a:b],
+                 chunk.offsets[start:stop + 1] - a)
+
+
+def read_chunks(path, size=None, start=0, stop=None):
+    """yields a Chunk for every size lines of the file"""
+    size = size or chunk_lines
+    block = []
+    for line in read_lines(path, start, stop):
+        block.append(line)
+        if len(block) >= size:
+            instrument.count_lines(block)
+            yield parse_lines(block)
+            block = []
+    if block:
+        instrument.count_lines(block)
+        yield parse_lines(block)
+
+
+def time_bounds(path):
+    """first and last timestamp, reads the whole file"""
+    first, last = None, None
+    for line in read_lines(path):
+        if len(line.split(',', 6)) < 7:
+            continue
+        last = line
+        if first is None:
+            first = line
+    return time_to_epoch(line_time(first)), time_to_epoch(line_time(last))
+
+
+class SweepIndex(object):
+    """sidecar path.idx mapping timestamps to byte offsets
+    one (epoch, offset) point about every index_stride bytes, extended as the file grows"""
+    magic = b'RTLPIDX1'
+    head = struct.Struct('<8sIqqq')
+    entry = struct.Struct('<qq')
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self.reset()
+        if path.endswith('.gz'):
+            self.load_members()
+            return
+        self.load()
+        self.update()
+
+    def load_members(self):
+        """an indexed gzip carries its own index, one point per member
+        the header of a member cut short by a truncated file overstates its last sweep,
+        that one is decoded to find where it really stops"""
+        end = os.path.getsize(self.path)
+        for member in gzip_members(self.path) or []:
+            offset, size, first, last = member
+            if offset + size > end:
+                first, last = member_bounds(self.path, member)
+            if first:
+                self.epochs.append(first)
+                self.offsets.append(offset)
+                self.last_epoch = last
+        self.indexed = os.path.getsize(self.path)
+
+    def reset(self):
+        self.epochs = []
+        self.offsets = []
+        self.indexed = 0
+        self.last_epoch = 0
+
+    def fingerprint(self):
+        with open(self.path, 'rb') as fd:
+            return zlib.crc32(fd.read(256)) & 0xffffffff
+
+    def load(self):
+        try:
+            with open(self.index_path, 'rb') as fd:
+                blob = fd.read()
+        except IOError:
+            return
+        if len(blob) < self.head.size:
+            return
+        magic, crc, self.indexed, self.last_epoch, count = self.head.unpack_from(blob)
+        if magic != self.magic or crc != self.fingerprint():
+            self.reset()
+            return
+        for i in range(count):
+            epoch, offset = self.entry.unpack_from(blob, self.head.size + i * self.entry.size)
+            self.epochs.append(epoch)
+            self.offsets.append(offset)
+
+    def save(self):
+        """a read-only folder only costs the next run a full scan"""
+        try:
+            with open(self.index_path, 'wb') as fd:
+                fd.write(self.head.pack(self.magic, self.fingerprint(), self.indexed,
+                                        self.last_epoch, len(self.epochs)))
+                for point in zip(self.epochs, self.offsets):
+                    fd.write(self.entry.pack(*point))
+        except OSError as e:
+            warn('could not write the index %s, the file will be scanned again next time (%s)' % (self.index_path, e))
+
+    def update(self):
+        """indexes the complete lines appended since the last run"""
+        size = os.path.getsize(self.path)
+        if size < self.indexed:
+            self.reset()
+        if size == self.indexed:
+            return
+        mark = self.offsets[-1] + index_stride if self.offsets else 0
+        pos = self.indexed
+        last = None
+        with open(self.path, 'rb') as fd:
+            fd.seek(pos)
+            for line in fd:
+                if not line.endswith(b'\n'):
+                    break  # still being written
+                if pos >= mark and len(line.split(b',', 6)) >= 7:
+                    self.epochs.append(time_to_epoch(line_time(line.decode('latin-1'))))
+                    self.offsets.append(pos)
+                    mark = pos + index_stride
+                last = line
+                pos += len(line)
+        if last is not None and len(last.split(b',', 6)) >= 7:
+            self.last_epoch = time_to_epoch(line_time(last.decode('latin-1')))
+        self.indexed = pos
+        self.save()
+
+    def first_epoch(self):
+        return self.epochs[0] if self.epochs else 0
+
+    def seek_range(self, begin=None, end=None):
+        """byte range holding every line between begin and end (epochs)"""
+        start, stop = 0, None
+        if begin is not None:
+            i = bisect.bisect_left(self.epochs, begin)
+            if i > 0:
+                start = self.offsets[i - 1]
+        if end is not None:
+            i = bisect.bisect_right(self.epochs, end)
+            if i < len(self.offsets):
+                stop = self.offsets[i]
+        return start, stop
@@ -2,102 +2,386 @@
 
 """
 takes raw iq, turns into heatmap
-extremely crude, lacks features like windowing
+streams the file through a memmap, one batched fft per block of frames
 """
 
-import sys, math, struct
+import os, sys, math, stat, json, time, argparse, calendar
 import numpy
+from numpy.lib.stride_tricks import sliding_window_view
 from PIL import Image
+import sweep_store
+import fft_backend
+import instrument
+from power_csv import duration_parse, load_jsonfile
 
-def help():
-    print("raw_iq.py bins averages sample-type input.raw")
-    print("  sample_types: u1 (uint8), s1 (int8), s2 (int16)")
-    sys.exit()
-
-def byte_reader(path, sample):
-    dtype = None
-    offset = 0
-    scale = 2**7
-    if sample == 'u1':
-        dtype = numpy.uint8
-        offset = -127
-    if sample == 's1':
-        dtype = numpy.int8
-    if sample == 's2':
-        dtype = numpy.int16
-        scale = 2**15
-    raw = numpy.fromfile(path, dtype).astype(numpy.float64)
+# raw dtype, offset, scale
+# cu8 is what rtl_sdr writes, u1/s1/s2 are the old names
+sample_types = {
+    'u1': (numpy.uint8, -127, 2**7),
+    's1': (numpy.int8, 0, 2**7),
+    's2': (numpy.int16, 0, 2**15),
+    'cu8': (numpy.uint8, -127, 2**7),
+    'cs8': (numpy.int8, 0, 2**7),
+    'cs16': (numpy.int16, 0, 2**15),
+    'cf32': (numpy.float32, 0, 1),
+}
+
+# SigMF core:datatype, little endian only
+sigmf_types = {'cu8': 'cu8', 'ci8': 'cs8', 'ci16_le': 'cs16', 'cf32_le': 'cf32'}
+
+# samples per batched fft, bounds the memory whatever the file size
+block_samples = 2**22
+
+class IQFile(object):
+    "memory-mapped interleaved iq, converted to complex64 one block at a time"
+    def __init__(self, path, sample):
+        self.sample = sample
+        self.raw = numpy.memmap(path, sample_types[sample][0], 'r')
+        self.length = len(self.raw) // 2
+
+    def read(self, start, stop):
+        return to_complex(self.raw[2*start:2*stop], self.sample)
+
+class IQStream(object):
+    "interleaved iq from stdin or a fifo, only read forward"
+    def __init__(self, fd, sample):
+        self.fd = fd
+        self.sample = sample
+        self.itemsize = 2 * numpy.dtype(sample_types[sample][0]).itemsize
+
+    def read(self, count):
+        "blocks until count samples arrived, fewer at the end of the stream"
+        blob = self.fd.read(count * self.itemsize)
+        blob = blob[:len(blob) - len(blob) % self.itemsize]
+        return to_complex(numpy.frombuffer(blob, sample_types[self.sample][0]), self.sample)
+
+def to_complex(raw, sample):
+    "interleaved raw samples to complex64, cf32 is only a view"
+    dtype, offset, scale = sample_types[sample]
+    if dtype == numpy.float32:
+        return raw.view(numpy.complex64)
+    raw = raw.astype(numpy.float32)
     raw += offset
     raw /= scale
-    return raw[0::2] + 1j * raw[1::2]
-
-def psd(data, bin_count, averages):
-    "really basic, lacks windowing"
-    length = len(data)
-    table = [numpy.zeros(bin_count)]
-    ave = 0
-    for i in range(0, length, bin_count):
-        sub_data = numpy.array(data[i:i+bin_count])
-        dc_bias = sum(sub_data) / len(sub_data)
-        #sub_data -= dc_bias
-        fft = numpy.fft.fft(sub_data)
-        if len(fft) != bin_count:
-            continue
-        table[-1] = table[-1] + numpy.real(numpy.conjugate(fft)*fft)
-        ave += 1
-        if ave >= averages:
-            ave = max(1, ave)
-            row = table[-1]
-            row = numpy.concatenate((row[bin_count//2:], row[:bin_count//2]))
-            # spurious warnings
-            table[-1] = 10 * numpy.log10(row / ave)
-            table.append(numpy.zeros(bin_count))
-            ave = 0
-    if ave != 0:
-        row = table[-1]
-        row = numpy.concatenate((row[bin_count//2:], row[:bin_count//2]))
-        table[-1] = 10 * numpy.log10(row / ave)
-    if ave == 0:
-        table.pop(-1)
-    return table
-
-def rgb2(z, lowest, highest):
-    g = (z - lowest) / (highest - lowest)
-    return (int(g*255), int(g*255), 50)
-
-def heatmap(table):
-    lowest = -1
-    highest = -100
-    for row in table:
-        lowest = min(lowest, min(z for z in row if not math.isinf(z)))
-        highest = max(highest, max(row))
-    img = Image.new("RGB", (len(table[0]), len(table)))
-    pix = img.load()
-    for y,row in enumerate(table):
-        for x,val in enumerate(row):
-            if not val >= lowest:  # fast nan/-inf test
-                val = lowest
-            pix[x,y] = rgb2(val, lowest, highest)
-    return img
+    data = numpy.empty(len(raw) // 2, numpy.complex64)
+    data.real = raw[0::2]
+    data.imag = raw[1::2]
+    return data
 
-if __name__ == '__main__':
+def read_sigmf(path):
+    "data path, sample type, rate, center and start epoch of a SigMF recording"
+    base = path.rsplit('.sigmf-', 1)[0]
+    with open(base + '.sigmf-meta') as fd:
+        meta = json.load(fd)
+    core = meta['global']
+    if core['core:datatype'] not in sigmf_types:
+        raise ValueError('unsupported SigMF datatype %s' % core['core:datatype'])
+    capture = (meta.get('captures') or [{}])[0]
+    start = None
+    if 'core:datetime' in capture:
+        stamp = capture['core:datetime'].rstrip('Z').split('.')[0]
+        start = calendar.timegm(time.strptime(stamp, '%Y-%m-%dT%H:%M:%S'))
+    return (base + '.sigmf-data', sigmf_types[core['core:datatype']],
+            core.get('core:sample_rate'), capture.get('core:frequency'), start)
+
+def make_window(name, bin_count):
+    "periodic, scaled so the noise floor stays where 'rect' puts it"
+    k = numpy.arange(bin_count) * 2 * numpy.pi / bin_count
+    if name == 'rect':
+        w = numpy.ones(bin_count)
+    elif name == 'hann':
+        w = 0.5 - 0.5 * numpy.cos(k)
+    elif name == 'blackman-harris':
+        w = 0.35875 - 0.48829 * numpy.cos(k) + 0.14128 * numpy.cos(2*k) - 0.01168 * numpy.cos(3*k)
+    else:
+        raise ValueError('unknown window %s' % name)
+    return (w / numpy.sqrt(numpy.mean(w**2))).astype(numpy.float32)
+
+def frame_hop(bin_count, overlap):
+    return max(1, int(round(bin_count * (1 - overlap))))
+
+def frame_count(length, bin_count, hop):
+    if length < bin_count:
+        return 0
+    return (length - bin_count) // hop + 1
+
+def average_rows(power, averages):
+    "mean of every averages frames, a short last row gets its own mean"
+    full = len(power) // averages
+    rows = power[:full*averages].reshape(full, averages, power.shape[1]).mean(axis=1)
+    if len(power) % averages:
+        rows = numpy.concatenate((rows, power[full*averages:].mean(axis=0, keepdims=True)))
+    rows = numpy.fft.fftshift(rows, axes=1)
+    # spurious warnings
+    with numpy.errstate(divide='ignore'):
+        return 10 * numpy.log10(rows)
+
+def psd_rows(source, bin_count, averages, window='rect', overlap=0, start=0, stop=None, fft=None):
+    "yields blocks of rows for frames [start, stop), start should be a multiple of averages"
+    fft = fft or fft_backend.NumpyFFT()
+    hop = frame_hop(bin_count, overlap)
+    frames = frame_count(source.length, bin_count, hop)
+    stop = frames if stop is None else min(stop, frames)
+    w = make_window(window, bin_count)
+    step = averages * max(1, block_samples // (averages * hop))
+    for f0 in range(start, stop, step):
+        f1 = min(f0 + step, stop)
+        block = source.read(f0 * hop, (f1 - 1) * hop + bin_count)
+        instrument.count(-(-(f1 - f0) // averages), (f1 - f0) * hop * source.raw.itemsize * 2)
+        spectra = fft.fft(sliding_window_view(block, bin_count)[::hop] * w)
+        yield average_rows(spectra.real**2 + spectra.imag**2, averages)
+
+def join_rows(rows, bin_count):
+    if not rows:
+        return numpy.zeros((0, bin_count), numpy.float32)
+    return numpy.concatenate(rows)
+
+def psd(source, bin_count, averages, window='rect', overlap=0, fft=None):
+    "table of dB rows, one per averages frames"
+    return join_rows(list(psd_rows(source, bin_count, averages, window, overlap, fft=fft)), bin_count)
+
+def frame_ranges(frames, averages, parts):
+    "about equal [start, stop) frame ranges, cut on row boundaries"
+    rows = int(math.ceil(frames / float(averages)))
+    cuts = [min(frames, rows * i // parts * averages) for i in range(parts + 1)]
+    return [(a, b) for a, b in zip(cuts, cuts[1:]) if a < b]
+
+# set before the pool forks, workers inherit it
+pool_job = None
+
+def psd_band(frames):
+    source, bin_count, averages, window, overlap, fft = pool_job
+    return join_rows(list(psd_rows(source, bin_count, averages, window, overlap,
+                                   frames[0], frames[1], fft)), bin_count)
+
+def psd_parallel(source, bin_count, averages, window='rect', overlap=0, fft=None, jobs=1):
+    "same table as psd(), ranges of rows computed by a pool of processes"
+    global pool_job
+    frames = frame_count(source.length, bin_count, frame_hop(bin_count, overlap))
+    bands = frame_ranges(frames, averages, jobs * 4)
+    context = instrument.fork_context()
+    if jobs < 2 or len(bands) < 2 or context is None:
+        return psd(source, bin_count, averages, window, overlap, fft)
+    pool_job = (source, bin_count, averages, window, overlap, fft)
+    pool = context.Pool(jobs)
     try:
-        _, bin_count, averages, sample, path = sys.argv
-        bin_count = int(bin_count)
-        bin_count = 2**(math.ceil(math.log2(bin_count)))
-        averages = int(averages)
-    except:
-        help()
-    print("loading data")
-    data = byte_reader(path, sample)
-    print("estimated size: %i x %i" % (bin_count,
-        int(len(data) / (bin_count*averages))))
-    print("crunching fft")
-    fft_table = psd(data, bin_count, averages)
-    print("drawing image")
-    img = heatmap(fft_table)
-    print("saving image")
-    img.save(path + '.png')
+        rows = []
+        for band in pool.imap(psd_band, bands):
+            rows.append(band)
+            instrument.tick()
+        return join_rows(rows, bin_count)
+    finally:
+        pool.close()
+        pool.join()
+
+def stream_rows(stream, bin_count, averages, window='rect', overlap=0, fft=None):
+    "yields each row as soon as its samples arrived, same rows as psd() on a file"
+    fft = fft or fft_backend.NumpyFFT()
+    hop = frame_hop(bin_count, overlap)
+    w = make_window(window, bin_count)
+    carry = numpy.zeros(0, numpy.complex64)
+    while True:
+        data = stream.read(averages * hop)
+        instrument.count(1, len(data) * stream.itemsize)
+        ended = len(data) < averages * hop
+        carry = numpy.concatenate((carry, data))
+        frames = frame_count(len(carry), bin_count, hop)
+        if not ended:
+            frames = frames // averages * averages
+        if frames:
+            block = carry[:(frames - 1) * hop + bin_count]
+            spectra = fft.fft(sliding_window_view(block, bin_count)[::hop] * w)
+            yield average_rows(spectra.real**2 + spectra.imag**2, averages)
+            carry = carry[frames * hop:]
+        if ended:
+            return
+
+def stamp(epoch):
+    "local time, like rtl_power"
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(epoch))
+
+def row_freqs(bin_count, center, rate):
+    "first frequency of every fftshifted bin"
+    return (center - rate / 2.0 + numpy.arange(bin_count) * float(rate) / bin_count).tolist()
+
+def csv_lines(rows, epochs, center, rate, samples):
+    "rtl_power style lines, one per row, so heatmap.py and flatten.py can read them"
+    bin_count = rows.shape[1]
+    head = '%i, %i, %.2f, %i' % (center - rate / 2, center + rate / 2, float(rate) / bin_count, samples)
+    for epoch, row in zip(epochs, rows):
+        yield '%s, %s, %s\n' % (stamp(epoch).replace(' ', ', '), head, ', '.join('%.2f' % z for z in row.tolist()))
+
+def labelled(table, center, rate, epochs, time_tick=None, db_limit=None, parameters=None):
+    "the table drawn by HeatmapGenerator, with the frequency tape, texts and legends"
+    # heatmap.py brings the fonts and tiles, only this path needs them
+    from heatmap import HeatmapGenerator
+    generator = HeatmapGenerator()
+    generator.time_tick = time_tick
+    if db_limit:
+        generator.set_db_limit(*db_limit)
+    if parameters:
+        generator.set_heatmap_parameters(parameters)
+    generator.calc_table_summary(table, row_freqs(table.shape[1], center, rate), [stamp(e) for e in epochs])
+    generator.calc_legends_height()
+    generator.init_heatmap()
+    generator.draw_table()
+    generator.label_heatmap()
+    generator.draw_texts()
+    generator.draw_legends()
+    return generator
+
+def rgb2(zs, lowest, highest):
+    "block of levels to an RGB array, same arithmetic (and dtype) as the old per pixel version"
+    g = (zs - lowest) / (highest - lowest)
+    rgb = numpy.empty(zs.shape + (3,), numpy.uint8)
+    rgb[..., 0] = rgb[..., 1] = g * 255
+    rgb[..., 2] = 50
+    return rgb
 
+def heatmap(table, block=1024):
+    "a block of rows at a time, a memory-mapped table is never read whole"
+    table = numpy.asarray(table)
+    lowest, highest = -1, -100
+    for y in range(0, len(table), block):
+        rows = table[y:y+block]
+        finite = numpy.isfinite(rows)
+        lowest = rows.min(initial=lowest, where=finite)
+        highest = rows.max(initial=highest, where=finite)
+    rgb = numpy.empty(table.shape + (3,), numpy.uint8)
+    for y in range(0, len(table), block):
+        rows = table[y:y+block]
+        # nan and -inf fail the comparison, drawn as the floor
+        rows = numpy.where(rows >= lowest, rows, lowest)
+        rgb[y:y+block] = rgb2(rows, lowest, highest)
+    return Image.fromarray(rgb)
 
+def store_table(path):
+    "memory-mapped, heatmap() reads it a block at a time and draws the NaN gaps as the floor"
+    return sweep_store.SweepStore(path).power
 
+def is_stream(path):
+    return path == '-' or stat.S_ISFIFO(os.stat(path).st_mode)
+
+def log(*message):
+    print(*message, file=sys.stderr)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sweep_store.is_store(sys.argv[1]):
+        path = sys.argv[1]
+        print("loading sweep store")
+        img = heatmap(store_table(path))
+        print("saving image")
+        img.save(path + '.png')
+        sys.exit()
+    parser = argparse.ArgumentParser(description='Turn raw IQ into a heatmap. (or: raw_iq.py input.sweeps, a quick look at a sweep store)')
+    parser.add_argument('bin_count', metavar='BINS', type=int,
+                        help='FFT size, rounded up to a power of two.')
+    parser.add_argument('averages', metavar='AVERAGES', type=int,
+                        help='Frames averaged into each row.')
+    parser.add_argument('sample', metavar='SAMPLE_TYPE', choices=sorted(sample_types) + ['sigmf'],
+                        help='cu8 (rtl_sdr), cs8, cs16, cf32, or sigmf to take it from the recording. (u1, s1, s2 are cu8, cs8, cs16)')
+    parser.add_argument('path', metavar='INPUT', type=str,
+                        help='Raw interleaved IQ file, a .sigmf-meta, or - / a fifo to stream. (rtl_sdr - | raw_iq.py ...)')
+    parser.add_argument('--window', dest='window', default='rect', choices=['rect', 'hann', 'blackman-harris'],
+                        help='FFT window. (default rect)')
+    parser.add_argument('--overlap', dest='overlap', type=float, default=0.0,
+                        help='Fraction of each frame shared with the next one, 0 to 0.9.')
+    parser.add_argument('--threads', dest='threads', type=int, default=1,
+                        help='FFT threads, needs scipy or pyfftw, numpy alone warns and uses one. (default 1)')
+    parser.add_argument('--fft', dest='fft', default='auto', choices=['auto', 'numpy', 'scipy', 'pyfftw'],
+                        help='FFT back-end, auto picks numpy for one thread, else pyfftw, then scipy, then numpy.')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help='Compute ranges of rows with N processes.')
+    parser.add_argument('--rate', dest='rate', type=float, default=None,
+                        help='Sample rate in Hz. (default from SigMF, else 2048000 like rtl_sdr)')
+    parser.add_argument('--center', dest='center', type=float, default=None,
+                        help='Center frequency in Hz, the image then gets the frequency tape and texts of heatmap.py. (default from SigMF)')
+    parser.add_argument('--ytick', dest='time_tick', default=None,
+                        help='With --center, place ticks along the Y axis every N seconds.')
+    parser.add_argument('--db', dest='db_limit', nargs=2, type=float, default=None,
+                        help='With --center, maximum and minimum db values.')
+    parser.add_argument('--parameters', dest='heatmap_parameters', default=None, action='append',
+                        help='With --center, heatmap parameters JSON file. (texts, legends)')
+    parser.add_argument('--csv', dest='csv', default=None,
+                        help='Write rtl_power style CSV rows to this file instead of an image, - for stdout. (streams default to stdout) '
+                             'Timestamps have one second resolution, pick AVERAGES so a row spans a second or more.')
+    parser.add_argument('--stats', '--run-stats', dest='run_stats', default=None, choices=['json', 'text'],
+                        help='Timings, bytes read and peak memory per phase on stderr at the end, progress every few seconds.')
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help='Profile the run into this file, .html or .txt use pyinstrument, else a cProfile dump.')
+    args = parser.parse_args()
+    if args.run_stats:
+        instrument.enable(args.run_stats)
+    if args.profile:
+        instrument.start_profile(args.profile)
+    bin_count = 2**(math.ceil(math.log2(args.bin_count)))
+    if not 0 <= args.overlap < 1:
+        parser.error('--overlap must be in [0, 1)')
+    try:
+        fft = fft_backend.select(args.fft, args.threads)
+    except ValueError as e:
+        parser.error(str(e))
+    path, sample, rate, center, start = args.path, args.sample, None, None, None
+    streaming = is_stream(path)
+    if sample == 'sigmf':
+        if streaming:
+            parser.error('a SigMF recording needs its .sigmf-meta, not a stream')
+        try:
+            path, sample, rate, center, start = read_sigmf(path)
+        except (IOError, ValueError, KeyError) as e:
+            parser.error('could not read SigMF metadata: %s' % e)
+    rate = args.rate or rate or 2048000
+    center = args.center if args.center is not None else center
+    csv = args.csv or ('-' if streaming else None)
+    if csv and center is None:
+        parser.error('CSV rows need --center')
+    samples = args.averages * bin_count
+
+    if streaming:
+        fd = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        out = sys.stdout if csv == '-' else open(csv, 'w')
+        with instrument.phase('streaming'):
+            for rows in stream_rows(IQStream(fd, sample), bin_count, args.averages, args.window, args.overlap, fft):
+                # rows are stamped when they come out, rtl_power does the same
+                out.writelines(csv_lines(rows, [time.time()] * len(rows), center, rate, samples))
+                out.flush()
+        sys.exit()
+
+    say = log if csv == '-' else print
+    say("loading data")
+    source = IQFile(path, sample)
+    hop = frame_hop(bin_count, args.overlap)
+    frames = frame_count(source.length, bin_count, hop)
+    say("estimated size: %i x %i" % (bin_count,
+        int(math.ceil(frames / float(args.averages)))))
+    say("crunching fft (%s, %i threads)" % (fft.name, fft.threads))
+    with instrument.phase('fft', source.length * source.raw.itemsize * 2):
+        fft_table = psd_parallel(source, bin_count, args.averages, args.window, args.overlap, fft, args.jobs)
+    if start is None:
+        start = os.path.getmtime(path) - source.length / rate
+    row_seconds = args.averages * hop / rate
+    epochs = [start + y * row_seconds for y in range(len(fft_table))]
+    if csv:
+        say("writing csv")
+        out = sys.stdout if csv == '-' else open(csv, 'w')
+        with instrument.phase('csv'):
+            out.writelines(csv_lines(fft_table, epochs, center, rate, samples))
+            out.flush()
+        sys.exit()
+    if center is not None:
+        # the same pipeline as the rtl_power csv files
+        parameters = {}
+        for filename in args.heatmap_parameters or []:
+            parameters.update(load_jsonfile(filename))
+        time_tick = duration_parse(args.time_tick) if args.time_tick else None
+        with instrument.phase('drawing'):
+            generator = labelled(fft_table, center, rate, epochs, time_tick, args.db_limit, parameters)
+        with instrument.phase('saving'):
+            generator.save(path + '.png')
+        sys.exit()
+    print("drawing image")
+    with instrument.phase('drawing'):
+        img = heatmap(fft_table)
+    print("saving image")
+    with instrument.phase('saving'):
+        img.save(path + '.png')
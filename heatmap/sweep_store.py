@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+
+"""
+compact binary store for rtl_power sweeps
+converts a csv once, later renders memory-map it and only touch the slices they need
+
+layout:
+  magic, uint32 header length, json header
+  int64 timestamps (rows), epoch seconds
+  float64 frequencies (cols)
+  int64 samples (cols), the rtl_power sample count of the hop behind each bin, since version 2
+  power matrix (rows x cols), float32 or float16, NaN where no sample
+"""
+
+import json, struct, argparse
+import numpy
+import power_csv
+
+magic = b'RTLSWEEP'
+align = 64
+
+
+def is_store(path):
+    try:
+        with open(path, 'rb') as fd:
+            return fd.read(len(magic)) == magic
+    except IOError:
+        return False
+
+
+def padded(n):
+    return (n + align - 1) // align * align
+
+
+class SweepStore(object):
+    """memory-mapped view of a store file"""
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(path, 'rb') as fd:
+            if fd.read(len(magic)) != magic:
+                raise ValueError('%s is not a sweep store' % path)
+            length, = struct.unpack('<I', fd.read(4))
+            self.header = json.loads(fd.read(length).decode('utf-8'))
+        h = self.header
+        rows, cols = h['rows'], h['cols']
+        self.hops = h['hops']
+        self.times = numpy.memmap(path, numpy.int64, mode, h['times_offset'], (rows,))
+        self.freqs = numpy.memmap(path, numpy.float64, mode, h['freqs_offset'], (cols,))
+        self.samples = None
+        if 'samples_offset' in h:
+            self.samples = numpy.memmap(path, numpy.int64, mode, h['samples_offset'], (cols,))
+        self.power = numpy.memmap(path, numpy.dtype(h['dtype']), mode, h['power_offset'], (rows, cols))
+
+    def col_range(self, low=None, high=None):
+        """columns with low <= freq <= high"""
+        start = 0
+        stop = len(self.freqs)
+        if low is not None:
+            start = int(numpy.searchsorted(self.freqs, low, 'left'))
+        if high is not None:
+            stop = int(numpy.searchsorted(self.freqs, high, 'right'))
+        return start, stop
+
+    def row_range(self, begin=None, end=None):
+        """rows with begin <= epoch <= end"""
+        start = 0
+        stop = len(self.times)
+        if begin is not None:
+            start = int(numpy.searchsorted(self.times, begin, 'left'))
+        if end is not None:
+            stop = int(numpy.searchsorted(self.times, end, 'right'))
+        return start, stop
+
+    def row_blocks(self, size=4096):
+        for y in range(0, len(self.times), size):
+            yield y, min(y + size, len(self.times))
+
+    def flush(self):
+        self.power.flush()
+
+
+def create(path, times, freqs, hops, dtype='float32', samples=None):
+    """writes an empty (all NaN) store, returns it opened for writing
+    samples is the per column sample count, 1 when not given"""
+    header = {'version': 2, 'dtype': numpy.dtype(dtype).name,
+              'rows': len(times), 'cols': len(freqs), 'hops': hops}
+    # offsets depend on the header size, settle them with a second pass
+    header.update(times_offset=0, freqs_offset=0, samples_offset=0, power_offset=0)
+    for _ in range(2):
+        length = len(json.dumps(header).encode('utf-8'))
+        header['times_offset'] = padded(len(magic) + 4 + length + 32)
+        header['freqs_offset'] = padded(header['times_offset'] + 8 * len(times))
+        header['samples_offset'] = padded(header['freqs_offset'] + 8 * len(freqs))
+        header['power_offset'] = padded(header['samples_offset'] + 8 * len(freqs))
+    blob = json.dumps(header).encode('utf-8')
+    size = header['power_offset'] + numpy.dtype(dtype).itemsize * len(times) * len(freqs)
+    with open(path, 'wb') as fd:
+        fd.write(magic + struct.pack('<I', len(blob)) + blob)
+        fd.truncate(size)
+    store = SweepStore(path, 'r+')
+    store.times[:] = times
+    store.freqs[:] = freqs
+    store.samples[:] = 1 if samples is None else samples
+    for y, y2 in store.row_blocks():
+        store.power[y:y2] = numpy.nan
+    return store
+
+
+def convert(csv_path, store_path, dtype='float32'):
+    """two passes over the csv: axes first, then the power matrix"""
+    times = set()
+    hops = {}
+    hop_samples = {}
+    for chunk in power_csv.read_chunks(csv_path):
+        times.update(chunk.times)
+        widths = numpy.diff(chunk.offsets).tolist()
+        for key in zip(chunk.low.tolist(), chunk.high.tolist(), chunk.step.tolist(), widths, chunk.samples.tolist()):
+            hops[key[:3]] = max(hops.get(key[:3], 0), key[3])
+            hop_samples[key[:3]] = key[4]
+
+    freqs = set()
+    for (low, high, step), width in hops.items():
+        freqs.update(list(power_csv.frange(low, high, step))[:width])
+    freqs = sorted(freqs)
+    freq_index = dict((f, x) for x, f in enumerate(freqs))
+    hop_col = dict((key, freq_index[key[0]]) for key in hops)
+    times = sorted(times)
+    time_index = dict((t, y) for y, t in enumerate(times))
+    # a bin shared by two hops ends up with the higher one, like its levels
+    samples = numpy.ones(len(freqs), numpy.int64)
+    for key in sorted(hops):
+        samples[hop_col[key]:hop_col[key] + hops[key]] = hop_samples[key]
+
+    store = create(store_path, [power_csv.time_to_epoch(t) for t in times], freqs,
+                   [list(key) for key in sorted(hops)], dtype, samples)
+    for chunk in power_csv.read_chunks(csv_path):
+        offsets = chunk.offsets.tolist()
+        keys = zip(chunk.low.tolist(), chunk.high.tolist(), chunk.step.tolist())
+        for i, key in enumerate(keys):
+            x = hop_col[key]
+            zs = chunk.levels[offsets[i]:offsets[i + 1]]
+            store.power[time_index[chunk.times[i]], x:x + len(zs)] = zs
+    store.flush()
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert rtl_power CSV files into a binary sweep store.')
+    parser.add_argument('input_path', metavar='INPUT', type=str,
+                        help='Input CSV file. (may be a .csv.gz)')
+    parser.add_argument('output_path', metavar='OUTPUT', type=str,
+                        help='Output sweep store.')
+    parser.add_argument('--float16', dest='dtype', action='store_const', const='float16', default='float32',
+                        help='Store half precision levels, half the size.')
+    args = parser.parse_args()
+    store = convert(args.input_path, args.output_path, args.dtype)
+    print("stored %i sweeps x %i bins" % store.power.shape)
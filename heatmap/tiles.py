@@ -0,0 +1,116 @@
+"""
+slippy map style tile pyramid (z/x/y) for heatmaps too big for one image
+the deepest zoom is the full resolution, each level above is a 2x2 mean of the one below
+"""
+
+import os, json, math
+import numpy
+from PIL import Image
+
+tile_size = 256
+
+
+def max_zoom(height, width):
+    return max(0, int(math.ceil(math.log(max(height, width) / float(tile_size), 2))))
+
+
+def halve(rows):
+    """2x2 NaN aware mean, odd edges padded with NaN"""
+    h, w = rows.shape
+    padded = numpy.full((h + h % 2, w + w % 2), numpy.nan)
+    padded[:h, :w] = rows
+    known = ~numpy.isnan(padded)
+    levels = numpy.where(known, padded, 0)
+    sums = levels[0::2, 0::2] + levels[1::2, 0::2] + levels[0::2, 1::2] + levels[1::2, 1::2]
+    counts = known[0::2, 0::2] * 1 + known[1::2, 0::2] + known[0::2, 1::2] + known[1::2, 1::2]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(counts > 0, sums / counts, numpy.nan)
+
+
+class LevelStream(object):
+    """rows of one zoom level, a row of tiles is written every tile_size rows
+    and handed down halved, so only one band per level is ever in memory"""
+
+    def __init__(self, pyramid, z):
+        self.pyramid = pyramid
+        self.z = z
+        self.rows = []
+        self.count = 0
+        self.tile_y = 0
+        self.parent = LevelStream(pyramid, z - 1) if z > 0 else None
+
+    def feed(self, block):
+        self.rows.append(block)
+        self.count += len(block)
+        while self.count >= tile_size:
+            band = numpy.concatenate(self.rows)
+            self.emit(band[:tile_size])
+            self.rows = [band[tile_size:]]
+            self.count -= tile_size
+
+    def close(self):
+        if self.count:
+            self.emit(numpy.concatenate(self.rows))
+        self.rows = []
+        self.count = 0
+        if self.parent is not None:
+            self.parent.close()
+
+    def emit(self, band):
+        for x in range(0, band.shape[1], tile_size):
+            self.pyramid.save_tile(self.z, x // tile_size, self.tile_y, band[:, x:x + tile_size])
+        self.tile_y += 1
+        if self.parent is not None:
+            self.parent.feed(halve(band))
+
+
+class TilePyramid(object):
+    """colorize turns a block of levels into RGB, like HeatmapGenerator.rgb2"""
+
+    def __init__(self, path, colorize, fmt='png'):
+        self.path = path
+        self.colorize = colorize
+        self.fmt = fmt
+
+    def tile_path(self, layer, z, x, y):
+        folder = os.path.join(self.path, layer, str(z), str(x))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        return os.path.join(folder, '%i.%s' % (y, self.fmt))
+
+    def save_tile(self, z, x, y, block):
+        """empty pixels and the padding past the edges are transparent"""
+        rgba = numpy.zeros((tile_size, tile_size, 4), numpy.uint8)
+        h, w = block.shape
+        rgba[:h, :w, :3] = self.colorize(block)
+        rgba[:h, :w, 3] = numpy.where(numpy.isnan(block), 0, 255)
+        Image.fromarray(rgba).save(self.tile_path('heatmap', z, x, y))
+
+    def write(self, levels, tape=None, info=None):
+        """levels is the full resolution (time x freq) array,
+        tape(width) draws the frequency tape that wide, labelled again for every zoom"""
+        height, width = levels.shape
+        zoom = max_zoom(height, width)
+        stream = LevelStream(self, zoom)
+        for y in range(0, height, tile_size):
+            stream.feed(levels[y:y + tile_size])
+        stream.close()
+        if tape is not None:
+            self.write_tape(tape, width, zoom)
+
+        meta = {'tile_size': tile_size, 'max_zoom': zoom, 'width': width, 'height': height,
+                'format': self.fmt, 'layers': ['heatmap'] + (['tape'] if tape is not None else [])}
+        meta.update(info or {})
+        with open(os.path.join(self.path, 'tiles.json'), 'w') as fd:
+            json.dump(meta, fd, indent=4)
+        return zoom
+
+    def write_tape(self, tape, width, zoom):
+        """one row of tiles per zoom, tape height tall"""
+        for z in range(zoom, -1, -1):
+            img = tape(int(math.ceil(width / 2.0 ** (zoom - z))))
+            w, h = img.size
+            for x in range(0, w, tile_size):
+                tile = Image.new('RGBA', (tile_size, h))
+                tile.paste(img.crop((x, 0, min(x + tile_size, w), h)), (0, 0))
+                tile.save(self.tile_path('tape', z, x // tile_size, 0))